@@ -0,0 +1,139 @@
+"""
+Tile server on asyncio streams, started by simple_server.py --async. Python 3 only.
+Each connection is a coroutine instead of a thread, idle keep alive connections of many browsers cost no thread.
+"""
+import asyncio
+import concurrent.futures
+import email.utils
+import http.client
+import posixpath
+from urllib.parse import unquote
+
+# Only the files of the web page are served
+SITE_PATHS = ("/tiles/", "/js/", "/css/", "/images/", "/index.html", "/leaflet-src.js")
+# Close idle keep alive connections after this number of seconds
+KEEP_ALIVE_TIMEOUT = 60
+# Requests with more header lines are rejected
+MAX_HEADERS = 100
+
+
+class AsyncTileServer:
+    """
+    Answer HTTP/1.1 requests of the TileSite
+    """
+    def __init__(self, site, workers):
+        self.site = site
+        # Files and the tile package are read in these threads, the event loop never waits for the disk
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers)
+
+    async def read_request(self, reader):
+        """
+        @return tuple of the request line words and the headers with lower case names, None if the connection is closed
+        """
+        request_line = await asyncio.wait_for(reader.readline(), KEEP_ALIVE_TIMEOUT)
+        if not request_line:
+            return None
+        headers = {}
+        for i in range(MAX_HEADERS):
+            line = await asyncio.wait_for(reader.readline(), KEEP_ALIVE_TIMEOUT)
+            if line in (b"\r\n", b"\n", b""):
+                return request_line.decode("latin-1").split(), headers
+            name, separator, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        raise ValueError("Too many headers")
+
+    async def handle_connection(self, reader, writer):
+        loop = asyncio.get_event_loop()
+        try:
+            keep_alive = True
+            while keep_alive:
+                request = await self.read_request(reader)
+                if request is None:
+                    break
+                words, headers = request
+                if len(words) != 3 or not words[2].startswith("HTTP/"):
+                    await self.send_response(writer, 400, [], b"Bad request", False)
+                    break
+                method, target, version = words
+                connection = headers.get("connection", "").lower()
+                keep_alive = connection != "close" if version >= "HTTP/1.1" else connection == "keep-alive"
+                if method not in ("GET", "HEAD"):
+                    # The request body is not read
+                    await self.send_response(writer, 501, [], b"Unsupported method", False)
+                    break
+                path = target.split('?', 1)[0].split('#', 1)[0]
+                site_path = posixpath.normpath(unquote(path))
+                response = None
+                if site_path == "/" or (site_path + "/").startswith(SITE_PATHS):
+                    response = await loop.run_in_executor(self.executor, self.site.respond, path, headers)
+                if response is None or response.status == 404:
+                    await self.send_response(writer, 404, [], b"File not found" if method == "GET" else b"",
+                                             keep_alive)
+                    continue
+                body = response.body
+                if response.status == 416:
+                    await self.send_response(writer, 416, response.headers, b"", keep_alive)
+                elif body is None or isinstance(body, bytes):
+                    await self.send_response(writer, response.status, response.headers,
+                                             body if method == "GET" else None, keep_alive)
+                else:
+                    # Open file
+                    with body:
+                        await self.send_response(writer, response.status, response.headers, None, keep_alive)
+                        if method == "GET":
+                            await self.send_file(writer, body, response.length)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+            # Idle, interrupted or invalid connection
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def send_response(writer, status, headers, body, keep_alive):
+        """
+        @param headers list of name, value tuples, a Content-Length is added to errors
+        """
+        lines = ["HTTP/1.1 %d %s" % (status, http.client.responses.get(status, "")),
+                 "Date: %s" % email.utils.formatdate(usegmt=True)]
+        if status >= 400:
+            headers = headers + [("Content-type", "text/plain"), ("Content-Length", str(len(body)))]
+        lines.extend("%s: %s" % header for header in headers)
+        if not keep_alive:
+            lines.append("Connection: close")
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        if body:
+            writer.write(body)
+        await writer.drain()
+
+    async def send_file(self, writer, f, length):
+        """
+        Send length bytes of the file from its current position
+        """
+        loop = asyncio.get_event_loop()
+        if hasattr(loop, "sendfile"):
+            # Python 3.7, the kernel copy the file into the socket, or the loop reads it in a thread
+            await loop.sendfile(writer.transport, f, f.tell(), length)
+        else:
+            writer.write(await loop.run_in_executor(self.executor, f.read, length))
+            await writer.drain()
+
+
+def serve(site, address, port, workers):
+    """
+    Serve the TileSite until interrupted
+    @param workers number of threads reading files
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    server = AsyncTileServer(site, workers)
+    listener = loop.run_until_complete(asyncio.start_server(server.handle_connection, address, port))
+    sa = listener.sockets[0].getsockname()
+    print("Serving HTTP on", sa[0], "port", sa[1], "with asyncio and", workers, "threads reading files ...")
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.close()
+        loop.run_until_complete(listener.wait_closed())
+        loop.close()
@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# This file is part of 7dtd-prefabs.
+#
+# 7dtd-prefabs is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# 7dtd-prefabs is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with 7dtd-prefabs. If not, see <http://www.gnu.org/licenses/>.
+# Source code hosted at https://github.com/nicolas-f/7dtd-prefabs
+"""
+Measure map_reader.py on synthetic .map files, without a game save
+"""
+from __future__ import print_function
+
+import struct
+import getopt
+import sys
+import os
+import time
+import json
+import random
+import hashlib
+import shutil
+import tempfile
+import subprocess
+import multiprocessing
+
+import map_reader
+
+# Tile of 16x16 pixels of the same sea color, repeated on all the ocean
+OCEAN_TILE = struct.pack("<H", (4 << 10) | (12 << 5) | 20) * 256
+# 15 bits BGR base colors of land tiles
+BIOME_COLORS = [(10, 17, 6), (17, 15, 9), (24, 24, 25), (14, 12, 8), (19, 19, 14)]
+# Ocean is decided by square areas of this number of tiles on each side
+OCEAN_AREA = 8
+
+
+def write_map_file(map_file, tiles, version):
+    """
+    Write a .map file in the layout read by MapReader.import_map_data
+    @param tiles list of tile index and 512 bytes of pixels
+    @param version 2 or 3
+    """
+    with open(map_file, "wb") as f:
+        f.write(b"map\0")
+        f.write(struct.pack("I", version))
+        if version == 3:
+            # Index of max_tiles_count entries, then the tiles
+            max_tiles_count = len(tiles)
+            f.write(struct.pack("II", max_tiles_count, len(tiles)))
+        else:
+            # Fixed index of 131072 entries, tiles start at 524300
+            max_tiles_count = (524300 - 12) // 4
+            if len(tiles) > max_tiles_count:
+                raise ValueError("Version 2 .map files contain at most %d tiles" % max_tiles_count)
+            f.write(struct.pack("I", len(tiles)))
+        f.write(struct.pack("%di" % len(tiles), *[index for index, data in tiles]))
+        f.write(b"\0" * ((max_tiles_count - len(tiles)) * 4))
+        for index, data in tiles:
+            f.write(data)
+
+
+def land_tiles(seed):
+    """
+    @return noisy variations of each biome color, a tile is made unique by its position written in its first pixels
+    """
+    variations = []
+    for biome in BIOME_COLORS:
+        for variation in range(64):
+            noise = bytearray(b"".join(hashlib.sha512(("%d-%d-%d-%d" % (seed, biome[0], variation, part))
+                                                      .encode("ascii")).digest() for part in range(4)))
+            pixels = [(min(31, biome[0] + (value & 3)) << 10) | (min(31, biome[1] + (value >> 2 & 3)) << 5) |
+                      min(31, biome[2] + (value >> 4 & 3)) for value in noise]
+            variations.append(struct.pack("<256H", *pixels))
+    return variations
+
+
+def tile_data(world, x, y):
+    """
+    Content of the world at this tile position, the same for all players
+    """
+    seed, ocean_share, variations = world
+    area = bytearray(hashlib.md5(("%d:%d:%d" % (seed, x // OCEAN_AREA, y // OCEAN_AREA)).encode("ascii")).digest())
+    if area[0] | area[1] << 8 < ocean_share * 65536:
+        return OCEAN_TILE
+    position = bytearray(hashlib.md5(("%d:%d:%d" % (seed, x, y)).encode("ascii")).digest())
+    # Neighbour tiles share the biome of their area
+    variation = variations[area[2] % len(BIOME_COLORS) * 64 + position[0] % 64]
+    return bytes(position[1:9]) + variation[8:]
+
+
+def generate_world(output_path, world_size=2048, players=8, tiles_per_player=20000, overlap=0.25, ocean_share=0.3,
+                   version=3, seed=1):
+    """
+    Write the .map files of players that explored parts of the same world
+    @param world_size number of tiles on each side of the world, centered on 0,0
+    @param tiles_per_player number of tiles explored by each player
+    @param overlap share of the tiles of each player in the area around 0,0 explored by all players
+    @param ocean_share share of the world covered by the ocean
+    @param version 2 or 3, layout of the .map files
+    @return list of written .map files
+    """
+    rng = random.Random(seed)
+    world = (seed, ocean_share, land_tiles(seed))
+    half = world_size // 2
+    map_files = []
+    for player in range(players):
+        shared = int(tiles_per_player * overlap)
+        # Areas explored around the common spawn and around the player base
+        areas = [(0, 0, shared)]
+        side = int((tiles_per_player - shared) ** 0.5) + 1
+        areas.append((rng.randint(-half + side, half - side), rng.randint(-half + side, half - side),
+                      tiles_per_player - shared))
+        explored = {}
+        for center_x, center_y, count in areas:
+            side = int(count ** 0.5) + 1
+            for i in range(count):
+                x, y = center_x - side // 2 + i % side, center_y - side // 2 + i // side
+                explored[map_reader.index_from_xy(x, y)] = tile_data(world, x, y)
+        map_file = os.path.join(output_path, "%d.map" % player)
+        write_map_file(map_file, list(explored.items()), version)
+        # Players last seen at different times, read_folder sorts files by date
+        file_date = 1500000000 + player * 3600
+        os.utime(map_file, (file_date, file_date))
+        map_files.append(map_file)
+    return map_files
+
+
+def commit_id():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.STDOUT).decode("ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(map_path, work_path, tile_level, jobs=1):
+    """
+    Time each step of create_tiles on the .map files
+    @return dict of the step name to its duration in seconds
+    """
+    tile_output_path = os.path.join(work_path, "tiles")
+    os.mkdir(tile_output_path)
+    map_files = map_reader.read_folder(map_path)
+    timings = {}
+    start = time.time()
+    reader = map_reader.MapReader(tile_output_path, False)
+    map_reader.import_map_files(reader, map_files, jobs)
+    reader.db.close()
+    timings["import"] = time.time() - start
+    start = time.time()
+    # Files are already imported, only the base tiles are rendered
+    map_reader.create_base_tiles(map_files, tile_output_path, tile_level, False, jobs)
+    timings["create_base_tiles"] = time.time() - start
+    start = time.time()
+    map_reader.create_low_zoom_tiles(tile_output_path, tile_level, jobs)
+    timings["create_low_zoom_tiles"] = time.time() - start
+    return timings
+
+
+def usage():
+    print("Generate synthetic .map files and measure the time taken by map_reader.py")
+    print("Usage: benchmark.py [options]")
+    print(" --world-size=2048:\t Number of tiles on each side of the world (Optional)")
+    print(" --players=8:\t\t Number of .map files (Optional)")
+    print(" --tiles=20000:\t\t Number of tiles explored by each player (Optional)")
+    print(" --overlap=0.25:\t Share of the tiles of each player explored by all players (Optional)")
+    print(" --ocean=0.3:\t\t Share of the world covered by the ocean, that has a single tile content (Optional)")
+    print(" --version=3:\t\t Layout of the .map files, 2 or 3 (Optional)")
+    print(" --seed=1:\t\t Seed of the generated world (Optional)")
+    print(" -j 1:\t\t\t Number of worker processes given to map_reader.py (Optional)")
+    print(" -o benchmark.json:\t Output file of the results (Optional)")
+    print(" --keep:\t\t Keep the generated files and tiles in the printed folder (Optional)")
+
+
+def main():
+    settings = {"world_size": 2048, "players": 8, "tiles_per_player": 20000, "overlap": 0.25, "ocean_share": 0.3,
+                "version": 3, "seed": 1}
+    jobs = 1
+    output_path = "benchmark.json"
+    keep = False
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "j:o:", ["world-size=", "players=", "tiles=", "overlap=",
+                                                          "ocean=", "version=", "seed=", "keep"])
+        for opt, value in opts:
+            if opt == "--world-size":
+                settings["world_size"] = int(value)
+            elif opt == "--players":
+                settings["players"] = int(value)
+            elif opt == "--tiles":
+                settings["tiles_per_player"] = int(value)
+            elif opt == "--overlap":
+                settings["overlap"] = float(value)
+            elif opt == "--ocean":
+                settings["ocean_share"] = float(value)
+            elif opt == "--version":
+                settings["version"] = int(value)
+            elif opt == "--seed":
+                settings["seed"] = int(value)
+            elif opt == "-j":
+                jobs = max(1, int(value))
+            elif opt == "-o":
+                output_path = value
+            elif opt == "--keep":
+                keep = True
+    except (getopt.error, ValueError):
+        usage()
+        exit(-1)
+    if settings["version"] not in (2, 3):
+        usage()
+        exit(-1)
+    # Smallest zoom level that contains the whole world
+    tile_level = 0
+    while 2**tile_level * 16 < settings["world_size"]:
+        tile_level += 1
+    # Times of each phase are written with the results
+    map_reader.phase_timer.enabled = True
+    work_path = tempfile.mkdtemp(prefix="map_reader_benchmark")
+    try:
+        map_path = os.path.join(work_path, "maps")
+        os.mkdir(map_path)
+        start = time.time()
+        generate_world(map_path, **settings)
+        print("Generated", settings["players"], ".map files in", round(time.time() - start, 2), "s")
+        timings = run_benchmark(map_path, work_path, tile_level, jobs)
+    finally:
+        if keep:
+            print("Generated files kept in", work_path)
+        else:
+            shutil.rmtree(work_path)
+    results = {"version": map_reader.__version__, "commit": commit_id(), "python": sys.version.split()[0],
+               "settings": dict(settings, tile_level=tile_level, jobs=jobs),
+               "timings": timings, "total": sum(timings.values()),
+               "phases": dict((phase, {"wall": times[0], "cpu": times[1], "calls": times[2]})
+                              for phase, times in map_reader.phase_timer.pop().items())}
+    with open(output_path, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    for step in ("import", "create_base_tiles", "create_low_zoom_tiles"):
+        print(step, round(timings[step], 3), "s")
+    print("Results written in", output_path)
+
+
+if __name__ == "__main__":
+    # Required by worker processes on windows
+    multiprocessing.freeze_support()
+    main()
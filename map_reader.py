@@ -26,10 +26,29 @@ import sys
 import os
 import time
 import sqlite3
+import multiprocessing
+import threading
+import collections
+import zlib
+import hashlib
+import mmap
+import array
+import io
+import contextlib
+import cProfile
+import json
+import pstats
+try:
+    from urllib.request import pathname2url
+except ImportError:
+    from urllib import pathname2url
+try:
+    import resource
+except ImportError:
+    # Windows, peak memory is not reported
+    resource = None
 __version__ = "1.3.4-dev"
 
-print("Welcome to 7DTD leaflet builder version " + __version__)
-
 try:
     from PIL import Image, ImageOps
 except ImportError:
@@ -37,6 +56,12 @@ except ImportError:
     print("Pillow https://pillow.readthedocs.org/en/latest/")
     exit(-1)
 
+try:
+    import numpy
+except ImportError:
+    # Optional, speed up tile decoding
+    numpy = None
+
 ##
 # Convert X Y position to MAP file index
 
@@ -44,6 +69,268 @@ except ImportError:
 def index_from_xy(x, y):
     return (y - 16) << 16 | (x & 65535)
 
+##
+# Convert MAP file index to X Y position
+
+
+def xy_from_index(index):
+    return ((index & 65535) ^ 32768) - 32768, (index >> 16) + 16
+
+
+def group_base_tiles(known_tiles, tile_level):
+    """
+    Group tile indexes by the 256x256 output tile that contains them
+    @param known_tiles iterable of tile indexes
+    @param tile_level extracted grid of 2**n output tiles on each side
+    @return dict of output tile column x to the set of output tile rows y that contains at least one tile
+    """
+    big_tile_range = 2**tile_level
+    tile_range = big_tile_range * 16
+    big_tiles = {}
+    for index in known_tiles:
+        world_x, world_y = xy_from_index(index)
+        x, y = (world_x + tile_range // 2) // 16, (world_y + tile_range // 2) // 16
+        # Skip tiles out of the extracted grid
+        if 0 <= x < big_tile_range and 0 <= y < big_tile_range:
+            big_tiles.setdefault(x, set()).add(y)
+    return big_tiles
+
+
+def file_fingerprint(file_path):
+    """
+    Cheap checksum of the file content
+    """
+    checksum = 0
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            checksum = zlib.crc32(chunk, checksum)
+    return checksum & 0xffffffff
+
+
+def mapped_file_version(file_stat, map_data):
+    """
+    Manifest record of the content of a memory mapped .map file, the file may be written again while it is imported
+    @param file_stat os.fstat of the file taken before it has been mapped
+    @return tuple of the modification time, the size and the file_fingerprint of the mapped content
+    """
+    checksum = 0
+    for i in range(0, len(map_data), 1 << 20):
+        checksum = zlib.crc32(map_data[i:i + (1 << 20)], checksum)
+    return file_stat.st_mtime, len(map_data), checksum & 0xffffffff
+
+
+def tile_digest(data):
+    """
+    Stable 64 bits digest of a tile content, stored as a signed sqlite integer. The same on Python 2 and 3.
+    """
+    return struct.unpack("<q", hashlib.md5(data).digest()[:8])[0]
+
+
+try:
+    process_time = time.process_time
+except AttributeError:
+    # Python 2
+    process_time = time.clock
+
+
+class _NoMeasure:
+    """
+    Context of PhaseTimer.measure when the timer is disabled
+    """
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+class PhaseTimer:
+    """
+    Wall clock and CPU time spent in each phase of the render. The time of a phase measured inside another one is
+    only counted in the inner phase.
+    Disabled by default, measure costs nothing until --profile or --stats enable it.
+    """
+    PHASES = ["check", "import", "fetch", "decode", "compose", "encode", "write", "read", "downsample"]
+    NO_MEASURE = _NoMeasure()
+
+    def __init__(self):
+        self.enabled = False
+        # phase -> [wall clock seconds, cpu seconds, calls]
+        self.phases = {}
+        self.lock = threading.Lock()
+        # Stack of the time of the inner phases, by thread
+        self.local = threading.local()
+
+    def measure(self, phase):
+        if not self.enabled:
+            return self.NO_MEASURE
+        return self.measure_enabled(phase)
+
+    @contextlib.contextmanager
+    def measure_enabled(self, phase):
+        stack = getattr(self.local, "stack", None)
+        if stack is None:
+            stack = self.local.stack = []
+        stack.append([0.0, 0.0])
+        start_wall, start_cpu = time.time(), process_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.time() - start_wall, process_time() - start_cpu
+            inner = stack.pop()
+            if len(stack) > 0:
+                stack[-1][0] += wall
+                stack[-1][1] += cpu
+            self.add(phase, wall - inner[0], cpu - inner[1], 1)
+
+    def add(self, phase, wall, cpu, calls):
+        with self.lock:
+            times = self.phases.setdefault(phase, [0.0, 0.0, 0])
+            times[0] += wall
+            times[1] += cpu
+            times[2] += calls
+
+    def pop(self):
+        """
+        @return the measured times, that are reset. Worker processes send them to the main process.
+        """
+        with self.lock:
+            phases, self.phases = self.phases, {}
+        return phases
+
+    def merge(self, phases):
+        for phase, times in phases.items():
+            self.add(phase, *times)
+
+    def table(self):
+        lines = ["%-12s %12s %12s %10s" % ("Phase", "Wall (s)", "CPU (s)", "Calls")]
+        for phase in self.PHASES + sorted(set(self.phases) - set(self.PHASES)):
+            if phase in self.phases:
+                lines.append("%-12s %12.3f %12.3f %10d" % tuple([phase] + self.phases[phase]))
+        return "\n".join(lines)
+
+
+# Times of this process, and of worker processes once their results are received
+phase_timer = PhaseTimer()
+
+
+class RunStats:
+    """
+    Counters of a run, written as JSON and in the Prometheus text format to monitor scheduled renders
+    """
+    def __init__(self):
+        self.start_time = time.time()
+        self.files_scanned = 0
+        self.files_skipped = 0
+        self.files_failed = 0
+        self.tiles_inserted = 0
+        self.duplicates_rejected = 0
+        # zoom level -> [written tiles, written bytes]
+        self.tiles_written = {}
+        # Identical tiles hard linked to an already written tile, by -d
+        self.tiles_linked = 0
+        self.lock = threading.Lock()
+
+    def tile_written(self, tile_level, written_bytes, linked=False):
+        with self.lock:
+            counts = self.tiles_written.setdefault(tile_level, [0, 0])
+            counts[0] += 1
+            counts[1] += written_bytes
+            if linked:
+                self.tiles_linked += 1
+
+    def pop(self):
+        """
+        @return the tiles written and linked since the last call, that are reset. Worker processes send them to the
+        main process.
+        """
+        with self.lock:
+            tiles_written, self.tiles_written = self.tiles_written, {}
+            tiles_linked, self.tiles_linked = self.tiles_linked, 0
+        return tiles_written, tiles_linked
+
+    def merge(self, tiles):
+        tiles_written, tiles_linked = tiles
+        with self.lock:
+            for tile_level, counts in tiles_written.items():
+                total = self.tiles_written.setdefault(tile_level, [0, 0])
+                total[0] += counts[0]
+                total[1] += counts[1]
+            self.tiles_linked += tiles_linked
+
+    def to_dict(self):
+        phases = {}
+        for phase, (wall, cpu, calls) in phase_timer.phases.items():
+            # A call process a .map file for the check and the import, a tile for the other phases
+            phases[phase] = {"wall_seconds": wall, "cpu_seconds": cpu, "count": calls,
+                             "per_second": calls / wall if wall > 0 else 0}
+        peak_memory = None
+        if resource is not None:
+            # Kilobytes on linux, bytes on mac
+            unit = 1 if sys.platform == "darwin" else 1024
+            peak_memory = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                              resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * unit
+        tiles_written = dict((str(tile_level), counts[0]) for tile_level, counts in self.tiles_written.items())
+        return {"version": __version__, "start_time": self.start_time,
+                "duration_seconds": time.time() - self.start_time, "files_scanned": self.files_scanned,
+                "files_skipped": self.files_skipped, "files_failed": self.files_failed,
+                "tiles_inserted": self.tiles_inserted, "duplicates_rejected": self.duplicates_rejected,
+                "tiles_written": tiles_written, "tiles_linked": self.tiles_linked,
+                "bytes_written": sum(counts[1] for counts in self.tiles_written.values()),
+                "phases": phases, "peak_memory_bytes": peak_memory}
+
+    def write(self, json_path):
+        """
+        Write the stats in json_path, and in the Prometheus text format in the .prom file of the same name
+        """
+        stats = self.to_dict()
+        with open(json_path, "w") as f:
+            json.dump(stats, f, indent=2, sort_keys=True)
+        metrics = [("last_run_timestamp_seconds", "Start time of the last run", [("", stats["start_time"])]),
+                   ("duration_seconds", "Duration of the last run", [("", stats["duration_seconds"])])]
+        for name in ("files_scanned", "files_skipped", "files_failed", "tiles_inserted", "duplicates_rejected",
+                     "tiles_linked", "bytes_written"):
+            metrics.append((name, name.replace("_", " ").capitalize() + " by the last run", [("", stats[name])]))
+        metrics.append(("tiles_written", "Tiles written by the last run, by zoom level",
+                        [('zoom="%s"' % tile_level, stats["tiles_written"][tile_level])
+                         for tile_level in sorted(stats["tiles_written"], key=int)]))
+        for key, description in (("wall_seconds", "Wall clock time of each phase of the last run"),
+                                 ("cpu_seconds", "CPU time of each phase of the last run"),
+                                 ("per_second",
+                                  "Files checked or imported, or tiles processed per second by each phase")):
+            metrics.append(("phase_" + key, description,
+                            [('phase="%s"' % phase, stats["phases"][phase][key]) for phase in sorted(stats["phases"])]))
+        if stats["peak_memory_bytes"] is not None:
+            metrics.append(("peak_memory_bytes", "Peak resident memory of the last run",
+                            [("", stats["peak_memory_bytes"])]))
+        prometheus_path = os.path.splitext(json_path)[0] + ".prom"
+        # Written aside then renamed, the collector never reads a partial file
+        with open(prometheus_path + ".tmp", "w") as f:
+            for name, description, samples in metrics:
+                f.write("# HELP map_reader_%s %s\n# TYPE map_reader_%s gauge\n" % (name, description, name))
+                for labels, value in samples:
+                    f.write("map_reader_%s%s %s\n" % (name, "{%s}" % labels if labels else "", repr(float(value))))
+        if os.path.exists(prometheus_path):
+            os.remove(prometheus_path)
+        os.rename(prometheus_path + ".tmp", prometheus_path)
+
+
+# Counters of this process, and of worker processes once their results are received
+run_stats = RunStats()
+
+
+def pop_worker_stats():
+    """
+    @return the phase times and written tiles of this worker process, sent to the main process
+    """
+    return phase_timer.pop(), run_stats.pop()
+
+
+def merge_worker_stats(stats):
+    if stats is not None:
+        phase_timer.merge(stats[0])
+        run_stats.merge(stats[1])
+
 
 class MapReader:
     db = None
@@ -51,40 +338,136 @@ class MapReader:
     tiles_file_path = {}
     known_tiles = set()
     new_tiles = 0
+    duplicate_tiles = 0
 
-    def __init__(self, database_directory, store_history):
-        self.db = sqlite3.connect(os.path.join(database_directory, 'tile_history.db'))
-        self.db.text_factory = str
+    def __init__(self, database_directory, store_history, read_only=False):
+        """
+        @param read_only open an existing database without writing to it nor loading known tiles, used by render
+        workers that only call fetch_tiles
+        """
+        db_path = os.path.join(database_directory, 'tile_history.db')
         self.store_history = store_history
+        # Index of tiles inserted or updated since the output tiles have been rendered
+        self.changed_tiles = set()
+        if read_only:
+            try:
+                self.db = sqlite3.connect("file:" + pathname2url(os.path.abspath(db_path)) + "?mode=ro", uri=True)
+            except TypeError:
+                # Python 2 sqlite3 does not support uri
+                self.db = sqlite3.connect(db_path)
+            self.db.text_factory = str
+            return
+        self.db = sqlite3.connect(db_path)
+        self.db.text_factory = str
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        # Tiles waiting to be inserted with a single executemany call
+        self.pending_tiles = []
+        self.insert_batch_size = 4096
         self.db.execute("CREATE TABLE IF NOT EXISTS TILES(POS int,HASH int, T TIMESTAMP, data CHAR(512),"
                         " PRIMARY KEY(POS,HASH))")
-        self.db.execute("CREATE TABLE IF NOT EXISTS VERSION as select 1 version")
+        self.db.execute("CREATE INDEX IF NOT EXISTS TILES_POS ON TILES(POS, T)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS FILES(PATH TEXT PRIMARY KEY, MTIME TIMESTAMP, SIZE int,"
+                        " FINGERPRINT int, HISTORY int)")
+        # Changed tiles are kept until the output tiles that contain them are rendered, an interrupted render is
+        # resumed by the next run
+        self.db.execute("CREATE TABLE IF NOT EXISTS CHANGED(POS int PRIMARY KEY)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS VERSION as select 3 version")
+        if self.db.execute("SELECT version FROM VERSION").fetchone()[0] < 3:
+            self.upgrade_tile_hash()
         # Read already known index
         for record in self.db.execute("SELECT DISTINCT POS FROM TILES"):
             self.known_tiles.add(record[0])
+        self.changed_tiles.update(record[0] for record in self.db.execute("SELECT POS FROM CHANGED"))
+
+    def upgrade_tile_hash(self):
+        """
+        Version 1 stored the python hash() of tiles, that change on each run, and version 2 a digest that depended
+        on the python version. Replace it by tile_digest and merge the duplicated versions of tiles, keeping the date
+        of the latest one so the same version of each tile is shown.
+        """
+        print("Upgrade tile database, please wait..")
+        self.db.create_function("tile_digest", 1, tile_digest)
+        self.db.execute("CREATE TABLE TILES_V2(POS int,HASH int, T TIMESTAMP, data CHAR(512), PRIMARY KEY(POS,HASH))")
+        self.db.execute("INSERT INTO TILES_V2 SELECT POS, tile_digest(data), MAX(T), data FROM TILES"
+                        " GROUP BY POS, tile_digest(data)")
+        self.db.execute("DROP TABLE TILES")
+        self.db.execute("ALTER TABLE TILES_V2 RENAME TO TILES")
+        self.db.execute("CREATE INDEX TILES_POS ON TILES(POS, T)")
+        self.db.execute("UPDATE VERSION SET version = 3")
+        self.db.commit()
+        self.db.execute("VACUUM")
 
     def is_tile_stored(self, index):
         return index in self.known_tiles
 
-    def do_insert_tile(self, index, tile_hash):
-        if self.store_history:
-            # Check if the tile is not already in the db
-            rs = self.db.execute("SELECT COUNT(*) CPT FROM TILES WHERE POS=? AND HASH=?", [index, tile_hash])
-            if rs.fetchone()[0] == 0:
-                return True
-            else:
-                return False
-        else:
-            return True
+    def insert_tile(self, index, data, file_date, tile_hash=None):
+        """
+        Buffer the tile, it is written with the next batch. Versions of tiles already stored are ignored then.
+        """
+        if tile_hash is None:
+            tile_hash = tile_digest(data)
+        self.pending_tiles.append((index, tile_hash, file_date, data))
+        self.known_tiles.add(index)
+        if len(self.pending_tiles) >= self.insert_batch_size:
+            self.flush_tiles()
 
-    def insert_tile(self, index, data, file_date):
-        tile_hash = hash(data)
-        if self.do_insert_tile(index, tile_hash):
-            self.db.execute("INSERT INTO TILES VALUES (?,?,?,?)", [index, tile_hash, file_date, data])
-            self.known_tiles.add(index)
-            return True
-        else:
-            return False
+    def stored_versions(self, positions):
+        """
+        @param positions list of tile indexes
+        @return dict of POS, HASH of the versions of these tiles already in the database to their date
+        """
+        stored = {}
+        # Stay below the sqlite limit of 999 variables by query
+        for i in range(0, len(positions), 900):
+            chunk = positions[i:i + 900]
+            for pos, tile_hash, file_date in self.db.execute("SELECT POS, HASH, T FROM TILES WHERE POS IN (%s)"
+                                                             % ",".join("?" * len(chunk)), chunk):
+                stored[(pos, tile_hash)] = file_date
+        return stored
+
+    def flush_tiles(self):
+        """
+        Write buffered tiles in the database
+        """
+        if len(self.pending_tiles) > 0:
+            new_tiles = self.pending_tiles
+            # Known versions seen again in a newer file, such as a tile back to a previous version
+            dated_tiles = []
+            if self.store_history:
+                # The primary key reject known versions, look them up only for this batch to count the new ones
+                stored = self.stored_versions(list(set(tile[0] for tile in self.pending_tiles)))
+                new_tiles = []
+                for tile in self.pending_tiles:
+                    stored_date = stored.get((tile[0], tile[1]))
+                    if stored_date is None:
+                        new_tiles.append(tile)
+                    elif tile[2] > stored_date:
+                        dated_tiles.append(tile)
+                    else:
+                        continue
+                    stored[(tile[0], tile[1])] = tile[2]
+            self.db.executemany("INSERT OR IGNORE INTO TILES VALUES (?,?,?,?)", new_tiles)
+            self.db.executemany("UPDATE TILES SET T=? WHERE POS=? AND HASH=?",
+                                [(tile[2], tile[0], tile[1]) for tile in dated_tiles])
+            changed_tiles = [tile[0] for tile in new_tiles + dated_tiles]
+            self.db.executemany("INSERT OR IGNORE INTO CHANGED VALUES (?)", [(pos,) for pos in changed_tiles])
+            self.changed_tiles.update(changed_tiles)
+            self.new_tiles += len(new_tiles)
+            self.duplicate_tiles += len(self.pending_tiles) - len(new_tiles)
+            self.pending_tiles = []
+
+    def commit(self):
+        self.flush_tiles()
+        self.db.commit()
+
+    def clear_changed_tiles(self):
+        """
+        Forget the changed tiles, once all output tiles that contain them have been rendered
+        """
+        self.db.execute("DELETE FROM CHANGED")
+        self.db.commit()
+        self.changed_tiles = set()
 
     def fetch_tile(self, index):
         if not self.is_tile_stored(index):
@@ -102,196 +485,1098 @@ class MapReader:
             else:
                 return None
 
+    def fetch_tiles(self, min_x, min_y, max_x, max_y):
+        """
+        Fetch all stored tiles in the world tile window [min_x, max_x] x [min_y, max_y] with a single query
+        @return dict of tile index to the tile_digest and data of the tile
+        """
+        # Tiles of a row are contiguous in POS, except when the row cross the x=0 column
+        ranges = []
+        for y in range(min_y, max_y + 1):
+            if min_x < 0 <= max_x:
+                ranges.append((index_from_xy(min_x, y), index_from_xy(-1, y)))
+                ranges.append((index_from_xy(0, y), index_from_xy(max_x, y)))
+            else:
+                ranges.append((index_from_xy(min_x, y), index_from_xy(max_x, y)))
+        # Rows are sorted by T, then the last version of each tile overwrite the older ones
+        query = "SELECT POS, HASH, data FROM TILES WHERE " + " OR ".join(["POS BETWEEN ? AND ?"] * len(ranges))
+        if self.store_history:
+            query += " ORDER BY POS, T"
+        tiles = {}
+        for pos, tile_hash, data in self.db.execute(query, list(itertools.chain(*ranges))):
+            tiles[pos] = (tile_hash, data)
+        return tiles
+
     def import_file(self, map_file, index_only):
-        file_date = os.stat(map_file).st_mtime
-        with open(map_file, "rb") as curs:
-            # Check beginning of file
-            header_magic = curs.read(4).decode('ascii')
-            if not header_magic.startswith("map"):
+        """
+        @return the mapped_file_version of the imported content, None if the file can not be read completely
+        """
+        with open(map_file, "rb") as f:
+            file_stat = os.fstat(f.fileno())
+            if file_stat.st_size < 12:
                 print("Skip " + os.path.basename(map_file) + " wrong file header")
-                return
-            ## Read version
-            version = struct.unpack("I", curs.read(4))[0]
-
-            tiles_pos = 524297
-            if version == 2:
-                tiles_pos = 524300
-            elif version == 3:
-                # Credits to DorHans & Seraphin for support of version 3
-                max_tiles_count = struct.unpack("I", curs.read(4))[0]
-                tiles_pos = max_tiles_count * 4 + 16
-            else:
-                print("Warning old map version or unsupported: ", version)
-                curs.seek(5)
-
-            #######################
-            # read index
-            num = struct.unpack("I", curs.read(4))[0]
-
-            # read tiles position
-            tiles_index = [struct.unpack("i", curs.read(4))[0] for i in range(num)]
-            #######################
-            # read tiles pixels
-            if not index_only:
-                curs.seek(tiles_pos)
-                for i in range(num):
-                    if self.store_history or not self.is_tile_stored(tiles_index[i]):
-                        # extract 16-bytes pixel 16*16 tile
-                        tile_data = curs.read(512)
-                        if len(tile_data) == 512:
-                            if self.insert_tile(tiles_index[i], tile_data, file_date):
-                                self.tiles_file_path[tiles_index[i]] = map_file
-                                self.new_tiles += 1
-                        else:
-                            # Corrupted file
-                            print("Skip " + os.path.basename(map_file) + " may be already used by another process")
-                            break
-                    else:
-                        curs.seek(curs.tell() + 512)
+                return None
+            map_data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                file_version = mapped_file_version(file_stat, map_data)
+                if self.import_map_data(map_data, map_file, file_stat.st_mtime, index_only):
+                    return file_version
+                return None
+            finally:
+                try:
+                    map_data.close()
+                except BufferError:
+                    # Tile views are still referenced by an exception traceback, the map is closed when collected
+                    pass
+
+    def import_map_data(self, map_data, map_file, file_date, index_only):
+        """
+        Import the tiles of a memory mapped .map file
+        """
+        map_index = read_map_index(map_data, map_file)
+        if map_index is None:
+            return False
+        tiles_index, tiles_pos = map_index
+        #######################
+        # read tiles pixels
+        complete = True
+        if not index_only:
+            try:
+                # Tiles are sliced from the mapped file without copy
+                map_view = memoryview(map_data)
+            except TypeError:
+                # Python 2 mmap does not support memoryview
+                map_view = map_data
+            complete = self.insert_map_tiles(map_file, file_date, tiles_index, map_view, tiles_pos)
+        else:
+            self.tiles = dict.fromkeys(tiles_index.tolist() + self.tiles.keys())
+        # Buffered tiles reference the mapped file, they must be written before it is closed
+        self.commit()
+        return complete
+
+    def import_parsed_file(self, map_file, parsed_file):
+        """
+        Import the tiles of a .map file read by parse_map_file in a worker process
+        """
+        tiles_index, tiles_data, tile_hashes, file_version = parsed_file
+        complete = self.insert_map_tiles(map_file, file_version[0], tiles_index, tiles_data, 0, tile_hashes)
+        self.commit()
+        return complete
+
+    def insert_map_tiles(self, map_file, file_date, tiles_index, tiles_data, tiles_pos, tile_hashes=None):
+        """
+        Insert the tiles of a .map file that are not already known
+        @param tiles_data tiles pixels, the tile i start at tiles_pos + i * 512
+        @param tile_hashes tile_digest of the tiles if already computed
+        @return False if the file is truncated
+        """
+        for i, tile_index in enumerate(tiles_index):
+            if self.store_history or not self.is_tile_stored(tile_index):
+                # extract 16-bytes pixel 16*16 tile
+                tile_pos = tiles_pos + i * 512
+                tile_data = tiles_data[tile_pos:tile_pos + 512]
+                if len(tile_data) == 512:
+                    # Counted as new or duplicate when the batch is written
+                    self.insert_tile(tile_index, tile_data, file_date, None if tile_hashes is None else tile_hashes[i])
+                    self.tiles_file_path[tile_index] = map_file
+                else:
+                    # Corrupted file
+                    print("Skip " + os.path.basename(map_file) + " may be already used by another process")
+                    return False
             else:
-                self.tiles = dict.fromkeys(tiles_index + self.tiles.keys())
+                self.duplicate_tiles += 1
+        return True
+
+    def is_file_imported(self, map_file):
+        """
+        Check in the manifest if this .map file has already been imported without changes since
+        """
+        file_stat = os.stat(map_file)
+        record = self.db.execute("SELECT MTIME, SIZE, FINGERPRINT, HISTORY FROM FILES WHERE PATH=?",
+                                 [os.path.abspath(map_file)]).fetchone()
+        # Tiles already known have not been stored if the file was imported without history
+        if record is None or record[1] != file_stat.st_size or record[3] < self.store_history:
+            return False
+        if record[0] == file_stat.st_mtime:
+            return True
+        # The file has been touched, check its content
+        if record[2] == file_fingerprint(map_file):
+            self.set_file_imported(map_file, (file_stat.st_mtime, file_stat.st_size, record[2]))
+            return True
+        return False
+
+    def set_file_imported(self, map_file, file_version):
+        """
+        Record this .map file in the manifest of imported files
+        @param file_version modification time, size and file_fingerprint of the imported content
+        """
+        self.db.execute("INSERT OR REPLACE INTO FILES VALUES (?,?,?,?,?)",
+                        [os.path.abspath(map_file)] + list(file_version) + [self.store_history])
         self.db.commit()
 
 
-def create_tiles(player_map_path, tile_output_path, tile_level, store_history):
+def read_map_index(map_data, map_file):
+    """
+    Read the header and the tile index of a memory mapped .map file
+    @return tuple of the tile index array and the offset of the first tile, None if the file can not be read
+    """
+    # Check beginning of file
+    header_magic = map_data[:4].decode('ascii', 'replace')
+    if not header_magic.startswith("map"):
+        print("Skip " + os.path.basename(map_file) + " wrong file header")
+        return None
+    ## Read version
+    version = struct.unpack_from("I", map_data, 4)[0]
+
+    tiles_pos = 524297
+    index_pos = 8
+    if version == 2:
+        tiles_pos = 524300
+    elif version == 3:
+        # Credits to DorHans & Seraphin for support of version 3
+        max_tiles_count = struct.unpack_from("I", map_data, 8)[0]
+        tiles_pos = max_tiles_count * 4 + 16
+        index_pos = 12
+    else:
+        print("Warning old map version or unsupported: ", version)
+        index_pos = 5
+
+    #######################
+    # read index
+    num = struct.unpack_from("I", map_data, index_pos)[0]
+
+    # read tiles position in one call
+    tiles_index = array.array("i")
+    index_data = map_data[index_pos + 4:index_pos + 4 + num * 4]
+    if len(index_data) != num * 4:
+        print("Skip " + os.path.basename(map_file) + " may be already used by another process")
+        return None
+    try:
+        tiles_index.frombytes(index_data)
+    except AttributeError:
+        # Python 2
+        tiles_index.fromstring(index_data)
+    return tiles_index, tiles_pos
+
+
+def parse_map_file(map_file):
+    """
+    Read all tiles of a .map file in a worker process, the main process insert them with
+    MapReader.import_parsed_file
+    @return tuple of the tile index array, the tiles pixels, their tile_digest and the mapped_file_version of the
+    file. None if the file can not be read.
+    """
+    with open(map_file, "rb") as f:
+        file_stat = os.fstat(f.fileno())
+        if file_stat.st_size < 12:
+            print("Skip " + os.path.basename(map_file) + " wrong file header")
+            return None
+        map_data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            file_version = mapped_file_version(file_stat, map_data)
+            map_index = read_map_index(map_data, map_file)
+            if map_index is None:
+                return None
+            tiles_index, tiles_pos = map_index
+            # All tiles in a single string, shorter if the file is truncated
+            tiles_data = map_data[tiles_pos:tiles_pos + len(tiles_index) * 512]
+        finally:
+            map_data.close()
+    tile_hashes = [tile_digest(tiles_data[i:i + 512]) for i in range(0, len(tiles_data) - 511, 512)]
+    return tiles_index, tiles_data, tile_hashes, file_version
+
+
+def parse_map_files(pool, map_files, prefetch):
+    """
+    Parse .map files in the worker processes, at most prefetch files ahead of the caller
+    @return iterator of the AsyncResult of parse_map_file, in the order of map_files
+    """
+    pending = collections.deque()
+    for map_file in map_files:
+        pending.append(pool.apply_async(parse_map_file, (map_file,)))
+        if len(pending) > prefetch:
+            yield pending.popleft()
+    while len(pending) > 0:
+        yield pending.popleft()
+
+
+class TileCache:
+    """
+    Least recently used cache of decoded tiles
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.items = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.items.pop(key, None)
+        if value is not None:
+            self.items[key] = value
+            self.hits += 1
+        else:
+            self.misses += 1
+        return value
+
+    def put(self, key, value):
+        self.items.pop(key, None)
+        self.items[key] = value
+        while len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+
+    def pop(self, key):
+        return self.items.pop(key, None)
+
+
+class PyramidBuilder:
+    """
+    Build the lower zoom tiles while the base tiles are rendered. Decoded tiles are kept in memory and feed the next
+    zoom level directly, so tiles are only written to disk.
+    Tiles must be added in pyramid_order, then a lower zoom tile is complete as soon as a tile of another lower zoom
+    tile is added.
+    """
+    def __init__(self, tile_store, tile_level_native, cache_size):
+        """
+        @param tile_store TileFolder or TilePackage where tiles are saved
+        @param cache_size maximum number of decoded tiles kept in memory, at least 4 by zoom level to never read a tile
+        back from disk
+        """
+        self.tile_store = tile_store
+        self.tile_level_native = tile_level_native
+        self.cache = TileCache(cache_size)
+        # zoom level -> (lower zoom tile, tiles of the zoom level that compose it)
+        self.pending = {}
+        self.evicted_reads = 0
+
+    def add(self, tile_level, tile, image):
+        self.cache.put((tile_level, tile[0], tile[1]), image)
+        if tile_level == 0:
+            return
+        lower_tile = (tile[0] // 2, tile[1] // 2)
+        if tile_level in self.pending and self.pending[tile_level][0] != lower_tile:
+            self.flush(tile_level)
+        self.pending.setdefault(tile_level, (lower_tile, []))[1].append(tile)
+
+    def flush(self, tile_level):
+        lower_tile, tiles = self.pending.pop(tile_level)
+        images = []
+        # Tiles that have not been rendered again are read from the previous run
+        for tile in lower_zoom_tile_children(lower_tile):
+            if tile not in tiles and self.tile_store.exists(tile_level, tile):
+                images.append((tile, self.tile_store.open(tile_level, tile)))
+        for tile in tiles:
+            # Children are not needed anymore once the lower tile is done
+            image = self.cache.pop((tile_level, tile[0], tile[1]))
+            if image is None:
+                # Evicted by a too small cache
+                self.evicted_reads += 1
+                image = self.tile_store.open(tile_level, tile)
+            images.append((tile, image))
+        lower_zoom_image = compose_low_zoom_tile(images)
+        self.tile_store.save(tile_level - 1, lower_tile, lower_zoom_image)
+        self.add(tile_level - 1, lower_tile, lower_zoom_image)
+
+    def close(self):
+        for tile_level in range(self.tile_level_native, 0, -1):
+            if tile_level in self.pending:
+                self.flush(tile_level)
+        if self.evicted_reads > 0:
+            print("Pyramid tiles read back from disk", self.evicted_reads, ", increase the memory cache size")
+
+
+def pyramid_order(tile_level, tile):
+    """
+    Sort key of a tile that follow a depth-first walk of the zoom pyramid, all tiles that share a lower zoom tile are
+    contiguous
+    """
+    return [(tile[0] >> (tile_level - level), tile[1] >> (tile_level - level)) for level in range(tile_level + 1)]
+
+
+def base_tile_index(tile_level, x, y):
+    """
+    Convert the x,y position in the extracted grid into the leaflet tile index
+    """
+    big_tile_range = 2**tile_level
+    return x - big_tile_range // 2, (big_tile_range - y) - big_tile_range // 2
+
+
+class TileFolder:
+    """
+    Leaflet tile folder, tiles are stored in {tile_output_path}/{z}/{x}/{y}.png
+    """
+    def __init__(self, tile_output_path, deduplicate=False):
+        """
+        @param deduplicate write only once tiles with the same pixels, the others are hard links to the first one
+        """
+        self.tile_output_path = tile_output_path
+        self.deduplicate = deduplicate
+        # pixels digest -> path of the first tile written with these pixels, and the reverse
+        self.written_tiles = {}
+        self.written_paths = {}
+
+    def __getstate__(self):
+        # Worker processes start with their own registry of written tiles
+        state = self.__dict__.copy()
+        state["written_tiles"] = {}
+        state["written_paths"] = {}
+        return state
+
+    def tile_path(self, tile_level, tile):
+        return os.path.join(self.tile_output_path, str(tile_level), str(tile[0]), str(tile[1]) + ".png")
+
+    def exists(self, tile_level, tile):
+        return os.path.exists(self.tile_path(tile_level, tile))
+
+    def has_tiles(self, tile_level):
+        return os.path.exists(os.path.join(self.tile_output_path, str(tile_level)))
+
+    def open(self, tile_level, tile):
+        with phase_timer.measure("read"):
+            image = Image.open(self.tile_path(tile_level, tile))
+            image.load()
+        return image
+
+    def list_tiles(self, tile_level):
+        """
+        @return x,y index of all tiles of the zoom level
+        """
+        z_path = os.path.join(self.tile_output_path, str(tile_level))
+        tiles = []
+        if not os.path.exists(z_path):
+            return tiles
+        # list all X folders, convert to int
+        for x_path in map(lambda x: int(x), os.listdir(z_path)):
+            for y_path in map(lambda y: int(y[:-4]), os.listdir(os.path.join(z_path, str(x_path)))):
+                tiles.append((x_path, y_path))
+        return tiles
+
+    def save(self, tile_level, tile, image):
+        png_path = self.tile_path(tile_level, tile)
+        x_path = os.path.dirname(png_path)
+        # Create Dirs if not exists, another worker may create it at the same time
+        if not os.path.exists(x_path):
+            try:
+                os.makedirs(x_path)
+            except OSError:
+                if not os.path.isdir(x_path):
+                    raise
+        # Never write into an existing file, it may be a hard link shared with other tiles
+        if os.path.exists(png_path):
+            os.remove(png_path)
+        if self.deduplicate:
+            key = self.written_paths.pop(png_path, None)
+            if key is not None:
+                del self.written_tiles[key]
+            key = hashlib.sha1(image.tobytes()).digest()
+            same_tile_path = self.written_tiles.get(key)
+            if same_tile_path is not None:
+                try:
+                    os.link(same_tile_path, png_path)
+                    run_stats.tile_written(tile_level, 0, True)
+                    return
+                except (OSError, AttributeError):
+                    # No hard link support, write the tile
+                    pass
+            else:
+                self.written_tiles[key] = png_path
+                self.written_paths[png_path] = key
+        with phase_timer.measure("encode"):
+            png_file = io.BytesIO()
+            image.save(png_file, "png")
+        with phase_timer.measure("write"):
+            with open(png_path, "wb") as f:
+                f.write(png_file.getvalue())
+        run_stats.tile_written(tile_level, png_file.tell())
+
+    def remove(self, tile_level, tile):
+        os.remove(self.tile_path(tile_level, tile))
+
+    def flush(self):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class TilePackage:
+    """
+    All zoom levels in a single MBTiles like SQLite file. The tile_column and tile_row of tiles are the x,y index of
+    the leaflet tiles/{z}/{x}/{y}.png url. Tiles with the same pixels are stored once in the images table.
+    The TileFolder methods are available, tiles are written by batches in a single transaction.
+    """
+    def __init__(self, package_path, batch_size=256):
+        self.package_path = package_path
+        self.batch_size = batch_size
+        self.db = None
+        # Tiles waiting to be written, (zoom level, x, y, tile id, png data or None if already written)
+        self.pending_tiles = []
+        self.written_ids = set()
+
+    def __getstate__(self):
+        # Worker processes open their own connection
+        state = self.__dict__.copy()
+        state["db"] = None
+        state["pending_tiles"] = []
+        state["written_ids"] = set()
+        return state
+
+    def connect(self):
+        if self.db is None:
+            # Wait for other worker processes that are writing
+            self.db = sqlite3.connect(self.package_path, timeout=600)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS metadata(name TEXT, value TEXT, UNIQUE(name))")
+            self.db.execute("CREATE TABLE IF NOT EXISTS map(zoom_level INTEGER, tile_column INTEGER,"
+                            " tile_row INTEGER, tile_id TEXT, PRIMARY KEY(zoom_level, tile_column, tile_row))")
+            self.db.execute("CREATE TABLE IF NOT EXISTS images(tile_id TEXT PRIMARY KEY, tile_data BLOB)")
+            self.db.execute("CREATE VIEW IF NOT EXISTS tiles AS SELECT map.zoom_level, map.tile_column,"
+                            " map.tile_row, images.tile_data FROM map JOIN images ON images.tile_id = map.tile_id")
+            self.db.commit()
+        return self.db
+
+    def exists(self, tile_level, tile):
+        self.flush()
+        return self.connect().execute("SELECT 1 FROM map WHERE zoom_level=? AND tile_column=? AND tile_row=?",
+                                      [tile_level, tile[0], tile[1]]).fetchone() is not None
+
+    def has_tiles(self, tile_level):
+        self.flush()
+        return self.connect().execute("SELECT 1 FROM map WHERE zoom_level=? LIMIT 1",
+                                      [tile_level]).fetchone() is not None
+
+    def open(self, tile_level, tile):
+        self.flush()
+        data = self.connect().execute("SELECT tile_data FROM tiles WHERE zoom_level=? AND tile_column=? AND"
+                                      " tile_row=?", [tile_level, tile[0], tile[1]]).fetchone()
+        if data is None:
+            raise IOError("No tile %d/%d/%d in %s" % (tile_level, tile[0], tile[1], self.package_path))
+        with phase_timer.measure("read"):
+            image = Image.open(io.BytesIO(data[0]))
+            image.load()
+        return image
+
+    def list_tiles(self, tile_level):
+        self.flush()
+        return [tuple(record) for record in self.connect().execute("SELECT tile_column, tile_row FROM map WHERE"
+                                                                   " zoom_level=?", [tile_level])]
+
+    def save(self, tile_level, tile, image):
+        tile_id = hashlib.sha1(image.tobytes()).hexdigest()
+        png_data = None
+        # Encode only tiles that have not been written yet
+        if tile_id not in self.written_ids:
+            self.written_ids.add(tile_id)
+            with phase_timer.measure("encode"):
+                png_file = io.BytesIO()
+                image.save(png_file, "png")
+            png_data = sqlite3.Binary(png_file.getvalue())
+        run_stats.tile_written(tile_level, 0 if png_data is None else len(png_data))
+        self.pending_tiles.append((tile_level, tile[0], tile[1], tile_id, png_data))
+        if len(self.pending_tiles) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.pending_tiles) > 0:
+            db = self.connect()
+            with phase_timer.measure("write"), db:
+                db.executemany("INSERT OR IGNORE INTO images VALUES (?,?)",
+                               [(tile_id, png_data) for _, _, _, tile_id, png_data in self.pending_tiles
+                                if png_data is not None])
+                db.executemany("INSERT OR REPLACE INTO map VALUES (?,?,?,?)",
+                               [pending_tile[:4] for pending_tile in self.pending_tiles])
+            self.pending_tiles = []
+
+    def disconnect(self):
+        """
+        Write pending tiles and close the connection before forking worker processes, a sqlite connection must not
+        be used across a fork. The connection is opened again on the next call.
+        """
+        self.flush()
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def close(self):
+        self.flush()
+        db = self.connect()
+        with db:
+            # Remove images of replaced tiles
+            db.execute("DELETE FROM images WHERE tile_id NOT IN (SELECT tile_id FROM map)")
+            zoom_range = db.execute("SELECT MIN(zoom_level), MAX(zoom_level) FROM map").fetchone()
+            db.executemany("INSERT OR REPLACE INTO metadata VALUES (?,?)",
+                           [("name", "7DTD map"), ("format", "png"), ("type", "baselayer"),
+                            ("version", __version__), ("minzoom", str(zoom_range[0])),
+                            ("maxzoom", str(zoom_range[1]))])
+        db.close()
+        self.db = None
+
+
+def create_tiles(player_map_path, tile_output_path, tile_level, store_history, jobs=1, cache_size=0,
+                 full_render=False, deduplicate=False, package_path=None):
     """
      Call base tile and intermediate zoom tiles
+     @param cache_size if not 0 build the zoom levels from the base tiles kept in memory, see PyramidBuilder
+     @param full_render render all tiles even if this zoom level has already been rendered. Otherwise only the tiles
+     that contain tiles changed by the .map files are rendered again.
+     @param deduplicate hard link identical tiles instead of writing them again
+     @param package_path if set, write tiles into this TilePackage file instead of png files in tile_output_path
     """
     if not os.path.exists(tile_output_path):
         os.mkdir(tile_output_path)
-    create_base_tiles(player_map_path, tile_output_path, tile_level, store_history)
-    create_low_zoom_tiles(tile_output_path, tile_level)
+    if package_path is not None:
+        tile_store = TilePackage(package_path)
+    else:
+        tile_store = TileFolder(tile_output_path, deduplicate)
+    incremental = not full_render and tile_store.has_tiles(tile_level)
+    if incremental:
+        print("Render only tiles changed since the last run")
+    reader = MapReader(tile_output_path, store_history)
+    if cache_size > 0:
+        pyramid = PyramidBuilder(tile_store, tile_level, cache_size)
+        create_base_tiles(player_map_path, tile_output_path, tile_level, store_history, jobs, pyramid, incremental,
+                          tile_store, reader)
+        pyramid.close()
+    else:
+        rendered_tiles = create_base_tiles(player_map_path, tile_output_path, tile_level, store_history, jobs,
+                                           incremental=incremental, tile_store=tile_store, reader=reader)
+        create_low_zoom_tiles(tile_output_path, tile_level, jobs, rendered_tiles if incremental else None,
+                              tile_store)
+    tile_store.close()
+    if deduplicate:
+        print("Identical tiles hard linked", run_stats.tiles_linked)
+    # All zoom levels are up to date
+    reader.clear_changed_tiles()
 
 
-def create_base_tiles(player_map_path, tile_output_path, tile_level, store_history):
+def create_base_tiles(player_map_path, tile_output_path, tile_level, store_history, jobs=1, pyramid=None,
+                      incremental=False, tile_store=None, reader=None):
     """
     Read all .map files and create a leaflet tile folder
     @param player_map_path array of folder name where are stored map
     @param tile_level number of tiles to extract around position 0,0 of map. It is in the form of 4^n tiles.It will
     extract a grid of 2**n tiles on each side. n=8 will give you an extraction of -128 +128 in X and Y tiles index.
+    @param jobs number of worker processes used to parse the .map files and render the output tiles
+    @param pyramid optional PyramidBuilder that receive the rendered tiles
+    @param incremental render only the output tiles that contain tiles changed by the .map files
+    @param tile_store TileFolder or TilePackage where tiles are saved, tile_output_path by default
+    @param reader MapReader of the tile database, opened in tile_output_path by default
+    @return set of leaflet index of the rendered output tiles
     """
-    reader = MapReader(tile_output_path, store_history)
-    # Read and merge all tiles in .map files
+    if reader is None:
+        reader = MapReader(tile_output_path, store_history)
+    if tile_store is None:
+        tile_store = TileFolder(tile_output_path)
+    import_map_files(reader, player_map_path, jobs)
     lastprint = 0
-    for i, map_file in enumerate(player_map_path):
-        if time.time() - lastprint > 1:
-            print("Read map file ", os.path.basename(map_file), i + 1, "/", len(player_map_path))
-            lastprint = time.time()
-        try:
-            reader.import_file(map_file, False)
-        except struct.error as e:
-            print("Skip " + os.path.basename(map_file) + " may be already used by another process", e)
-        except OSError as e:
-            print("Skip " + os.path.basename(map_file) + " may be already used by another process", e)
 
-    # make zoom folder
-    z_path = os.path.join(tile_output_path, str(tile_level))
-    if not os.path.exists(z_path):
-        os.mkdir(z_path)
     # compute min-max X Y
-    big_tile_range = 2**tile_level
-    tile_range = big_tile_range*16
-    # iterate on x
-    minmax_tile = [(tile_range, tile_range),(-tile_range, -tile_range)]
+    tile_range = 2**tile_level*16
+    minmax_tile = [(tile_range, tile_range), (-tile_range, -tile_range)]
     used_tiles = 0
-    for x in range(2**tile_level):
+    # Only visit output tiles that contain at least one known tile
+    big_tiles = group_base_tiles(reader.changed_tiles if incremental else reader.known_tiles, tile_level)
+    if pyramid is None:
+        # Work by X column
+        work = [[(x, y) for y in sorted(big_tiles[x])] for x in sorted(big_tiles.keys())]
+    else:
+        # The pyramid need the tiles in its order, send them by small groups
+        tiles = sorted(((x, y) for x in big_tiles.keys() for y in big_tiles[x]),
+                       key=lambda xy: pyramid_order(tile_level, base_tile_index(tile_level, xy[0], xy[1])))
+        work = [tiles[i:i + 16] for i in range(0, len(tiles), 16)]
+    keep_images = pyramid is not None
+    if jobs > 1:
+        # Each worker read tiles from its own read-only connection
+        tile_store.disconnect()
+        pool = multiprocessing.Pool(jobs, _init_worker, (tile_store, tile_output_path, store_history,
+                                                         phase_timer.enabled))
+        tasks = [(tile_level, tiles, keep_images) for tiles in work]
+        if pyramid is None:
+            results = pool.imap_unordered(_render_base_tiles_worker, tasks)
+        else:
+            results = pool.imap(_render_base_tiles_worker, tasks)
+    else:
+        results = (render_base_tiles(reader, tile_store, tile_level, tiles, keep_images) + (None,)
+                   for tiles in work)
+    cache_hits, cache_misses, skipped_decodes = 0, 0, 0
+    for i, (work_used_tiles, work_minmax, images, cache_counts, stats) in enumerate(results):
+        merge_worker_stats(stats)
         if time.time() - lastprint > 1:
-            print("Write tile X:", x + 1, " of ", 2 ** tile_level)
+            print("Write tiles ", i + 1, " of ", len(work))
             lastprint = time.time()
-        x_dir_make = False
-        x_path = os.path.join(z_path, str(x - big_tile_range // 2))
-        for y in range(2**tile_level):
-            # Fetch 256 tiles
-            big_tile = None
-            # Combine two for loop into one
-            for tx, ty in itertools.product(range(16), range(16)):
-                world_txy = (x * 16 + tx - tile_range // 2, y * 16 + ty - tile_range // 2)
-                tile_data = reader.fetch_tile(index_from_xy(world_txy[0], world_txy[1]))
-                if not tile_data is None:
-                    used_tiles += 1
-                    minmax_tile = [(min(minmax_tile[0][0], world_txy[0]), min(minmax_tile[0][1], world_txy[1])),
-                                   (max(minmax_tile[1][0], world_txy[0]), max(minmax_tile[1][1], world_txy[1]))]
-                    # Add this tile to big tile
-                    # Create empty big tile if not exists
-                    if big_tile is None:
-                        big_tile = Image.new("RGBA", (256, 256))
-                    # convert image string into pil image
-                    try:
-                        tile_im = Image.frombuffer('RGB', (16, 16), tile_data, 'raw', 'BGR;15', 0, 1)
-                        # Push this tile into the big one
-                        big_tile.paste(tile_im, (tx * 16, ty * 16))
-                    except ValueError:
-                        print("The following file is corrupted, skip it:\n" +
-                              reader.tiles_file_path.get(index_from_xy(world_txy[0], world_txy[1])))
-            # All 16pix tiles of this big tile has been copied into big tile
-            # Time to save big tile
-            if not big_tile is None:
-                # Create Dirs if not exists
-                if not x_dir_make:
-                    if not os.path.exists(x_path):
-                        os.mkdir(x_path)
-                        x_dir_make = True
-                png_path = os.path.join(x_path, str((big_tile_range - y) - big_tile_range // 2)+".png")
-                big_tile = ImageOps.flip(big_tile)
-                big_tile.save(png_path, "png")
+        used_tiles += work_used_tiles
+        cache_hits += cache_counts[0]
+        cache_misses += cache_counts[1]
+        skipped_decodes += cache_counts[2]
+        minmax_tile = [(min(minmax_tile[0][0], work_minmax[0][0]), min(minmax_tile[0][1], work_minmax[0][1])),
+                       (max(minmax_tile[1][0], work_minmax[1][0]), max(minmax_tile[1][1], work_minmax[1][1]))]
+        for tile, image in images:
+            if not isinstance(image, Image.Image):
+                image = Image.frombytes("RGBA", (256, 256), image)
+            pyramid.add(tile_level, tile, image)
+    if jobs > 1:
+        pool.close()
+        pool.join()
+    tile_store.flush()
     print("Min max tiles minx:", minmax_tile[0][0], " maxx:", minmax_tile[1][0],
           "miny:", minmax_tile[0][1], " maxy: ", minmax_tile[1][1])
     print("Tiles used / total read", used_tiles, " / ", reader.new_tiles)
+    if numpy is None:
+        print("Decoded tiles cache hits / misses", cache_hits, " / ", cache_misses)
+    else:
+        print("Tiles not decoded, identical to another tile of their output tile", skipped_decodes)
+    return set(base_tile_index(tile_level, x, y) for x in big_tiles.keys() for y in big_tiles[x])
 
 
-def create_low_zoom_tiles(tile_output_path, tile_level_native):
+def import_map_files(reader, player_map_path, jobs=1):
+    """
+    Read and merge all tiles of the .map files into the tile database
+    @param reader MapReader of the tile database
+    @param player_map_path list of .map file path, tiles of the first files take precedence
+    @param jobs number of worker processes that parse the .map files, tiles are inserted in the order of the files by
+    this process
+    """
+    lastprint = 0
+    skipped_files = 0
+    new_tiles, duplicate_tiles = reader.new_tiles, reader.duplicate_tiles
+    map_files = []
+    for map_file in player_map_path:
+        try:
+            with phase_timer.measure("check"):
+                # Skip files that did not change since the last run
+                if reader.is_file_imported(map_file):
+                    skipped_files += 1
+                else:
+                    map_files.append(map_file)
+        except OSError as e:
+            run_stats.files_failed += 1
+            print("Skip " + os.path.basename(map_file) + " may be already used by another process", e)
+    pool = None
+    if jobs > 1 and len(map_files) > 1:
+        pool = multiprocessing.Pool(min(jobs, len(map_files)))
+        # Bound the parsed files waiting in memory
+        parsed_files = parse_map_files(pool, map_files, jobs * 2)
+    try:
+        for i, map_file in enumerate(map_files):
+            if time.time() - lastprint > 1:
+                print("Read map file ", os.path.basename(map_file), i + 1, "/", len(map_files))
+                lastprint = time.time()
+            try:
+                with phase_timer.measure("import"):
+                    if pool is None:
+                        file_version = reader.import_file(map_file, False)
+                        if file_version is not None:
+                            reader.set_file_imported(map_file, file_version)
+                    else:
+                        parsed_file = next(parsed_files).get()
+                        if parsed_file is not None and reader.import_parsed_file(map_file, parsed_file):
+                            reader.set_file_imported(map_file, parsed_file[3])
+            except struct.error as e:
+                run_stats.files_failed += 1
+                print("Skip " + os.path.basename(map_file) + " may be already used by another process", e)
+            except OSError as e:
+                run_stats.files_failed += 1
+                print("Skip " + os.path.basename(map_file) + " may be already used by another process", e)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    run_stats.files_scanned += len(player_map_path)
+    run_stats.files_skipped += skipped_files
+    run_stats.tiles_inserted += reader.new_tiles - new_tiles
+    run_stats.duplicates_rejected += reader.duplicate_tiles - duplicate_tiles
+    if skipped_files > 0:
+        print("Unchanged map files skipped", skipped_files, "/", len(player_map_path))
+
+
+def import_tiles(player_map_path, tile_output_path, tile_level, store_history, jobs=1):
+    """
+    Only import the .map files into the tile database, tiles are rendered on demand by simple_server.py --render.
+    Rendered tiles that contain changed tiles are removed to be rendered again.
+    """
+    if not os.path.exists(tile_output_path):
+        os.mkdir(tile_output_path)
+    reader = MapReader(tile_output_path, store_history)
+    import_map_files(reader, player_map_path, jobs)
+    tile_store = TileFolder(tile_output_path)
+    removed_tiles = 0
+    for zoom_level, tiles in pyramid_tiles(reader.changed_tiles, tile_level).items():
+        for tile in tiles:
+            if tile_store.exists(zoom_level, tile):
+                tile_store.remove(zoom_level, tile)
+                removed_tiles += 1
+    reader.clear_changed_tiles()
+    print("Tiles imported", reader.new_tiles, ", outdated rendered tiles removed", removed_tiles)
+
+
+def pyramid_tiles(known_tiles, tile_level):
+    """
+    @param known_tiles iterable of tile indexes
+    @return dict of zoom level to the set of leaflet index of the tiles that contain at least one known tile
+    """
+    big_tiles = group_base_tiles(known_tiles, tile_level)
+    tiles = {tile_level: set(base_tile_index(tile_level, x, y) for x in big_tiles.keys() for y in big_tiles[x])}
+    for zoom_level in range(tile_level, 0, -1):
+        tiles[zoom_level - 1] = set((tile[0] // 2, tile[1] // 2) for tile in tiles[zoom_level])
+    return tiles
+
+
+def render_base_tile(reader, tile_level, x, y):
+    """
+    Compose the 256x256 output tile x,y of the extracted grid from the stored 16x16 tiles
+    @return tuple of the image (None if no tile is stored there) and the list of used world tile positions
+    """
+    tile_range = 2**tile_level*16
+    used_positions = []
+    sub_tiles = []
+    # Fetch 256 tiles
+    world_x, world_y = x * 16 - tile_range // 2, y * 16 - tile_range // 2
+    with phase_timer.measure("fetch"):
+        tiles = reader.fetch_tiles(world_x, world_y, world_x + 15, world_y + 15)
+    # Combine two for loop into one
+    for tx, ty in itertools.product(range(16), range(16)):
+        world_txy = (world_x + tx, world_y + ty)
+        index = index_from_xy(world_txy[0], world_txy[1])
+        tile = tiles.get(index)
+        if not tile is None:
+            used_positions.append(world_txy)
+            if len(tile[1]) < 512:
+                print("The following file is corrupted, skip it:\n" + str(reader.tiles_file_path.get(index, index)))
+            else:
+                sub_tiles.append((tx, ty) + tile)
+    if len(used_positions) == 0:
+        return None, used_positions
+    with phase_timer.measure("compose"):
+        return compose_base_tile(sub_tiles), used_positions
+
+
+def compose_base_tile(sub_tiles):
+    """
+    Paste 16x16 tiles into a big 256x256 tile. Identical tiles are decoded only once, see decoded_tile_cache.
+    @param sub_tiles list of tx, ty position, tile_digest and 512 bytes of 15 bits BGR pixels
+    @return vertically flipped RGBA image, transparent where there is no tile
+    """
+    if numpy is not None:
+        return compose_base_tile_numpy(sub_tiles)
+    big_tile = Image.new("RGBA", (256, 256))
+    for tx, ty, tile_hash, tile_data in sub_tiles:
+        tile_im = decoded_tile_cache.get(tile_hash)
+        if tile_im is None:
+            # convert image string into pil image
+            with phase_timer.measure("decode"):
+                tile_im = Image.frombuffer('RGB', (16, 16), tile_data, 'raw', 'BGR;15', 0, 1)
+            decoded_tile_cache.put(tile_hash, tile_im)
+        # Push this tile into the big one
+        big_tile.paste(tile_im, (tx * 16, ty * 16))
+    return ImageOps.flip(big_tile)
+
+
+# 5 bits to 8 bits color channel, same rounding as the Pillow BGR;15 decoder
+_CHANNEL_5_TO_8 = None if numpy is None else (numpy.arange(32) * 255 // 31).astype(numpy.uint8)
+
+
+def decode_tiles_numpy(tiles_data):
+    """
+    Decode 15 bits BGR tiles at once
+    @return array of [tile, flipped pixel row, pixel column, RGB channel]
+    """
+    pixels = numpy.frombuffer(b"".join([bytes(tile_data[:512]) for tile_data in tiles_data]), "<u2")
+    # Flip rows of each tile, the flipped tile row is done when pasting the tile
+    pixels = pixels.reshape((len(tiles_data), 16, 16))[:, ::-1, :]
+    rgb = numpy.empty((len(tiles_data), 16, 16, 3), numpy.uint8)
+    rgb[..., 0] = _CHANNEL_5_TO_8[(pixels >> 10) & 31]
+    rgb[..., 1] = _CHANNEL_5_TO_8[(pixels >> 5) & 31]
+    rgb[..., 2] = _CHANNEL_5_TO_8[pixels & 31]
+    return rgb
+
+
+def compose_base_tile_numpy(sub_tiles):
+    """
+    compose_base_tile decoding all tiles at once with NumPy. The batch decode is cheaper than decoded_tile_cache
+    lookups, only the identical tiles of this output tile are decoded once.
+    """
+    big_tile = numpy.zeros((256, 256, 4), numpy.uint8)
+    if len(sub_tiles) > 0:
+        tx = numpy.array([sub_tile[0] for sub_tile in sub_tiles])
+        ty = numpy.array([sub_tile[1] for sub_tile in sub_tiles])
+        # tile_digest -> index of the tile in the decoded batch
+        batch_index = {}
+        order = [batch_index.setdefault(sub_tile[2], len(batch_index)) for sub_tile in sub_tiles]
+        batch = [None] * len(batch_index)
+        for sub_tile, i in zip(sub_tiles, order):
+            batch[i] = sub_tile[3]
+        global identical_tiles
+        identical_tiles += len(sub_tiles) - len(batch)
+        with phase_timer.measure("decode"):
+            decoded = decode_tiles_numpy(batch)
+        # View the big tile as blocks [tile row, pixel row, tile column, pixel column, channel]
+        blocks = big_tile.reshape((16, 16, 16, 16, 4))
+        flipped_ty = 15 - ty
+        blocks[flipped_ty, :, tx, :, :3] = decoded[order] if len(batch) < len(sub_tiles) else decoded
+        blocks[flipped_ty, :, tx, :, 3] = 255
+    return Image.fromarray(big_tile)
+
+
+# Decoded 16x16 tiles by tile_digest of their content, large areas such as ocean share the same tiles.
+# Used without NumPy.
+decoded_tile_cache = TileCache(4096)
+# Tiles not decoded by the NumPy path because an identical tile of the same output tile has been decoded
+identical_tiles = 0
+
+
+def render_base_tiles(reader, tile_store, tile_level, tiles, keep_images):
+    """
+    Render and save the output tiles
+    @param tiles x,y position in the extracted grid of output tiles that contains at least one known tile
+    @param keep_images return the rendered images
+    @return tuple of the number of used tiles, the min-max world tile positions, the list of leaflet tile index
+    and image and the number of decoded tiles cache hits, misses and of identical_tiles
+    """
+    cache_counts = (decoded_tile_cache.hits, decoded_tile_cache.misses, identical_tiles)
+    tile_range = 2**tile_level*16
+    minmax_tile = [(tile_range, tile_range), (-tile_range, -tile_range)]
+    used_tiles = 0
+    images = []
+    for x, y in tiles:
+        big_tile, used_positions = render_base_tile(reader, tile_level, x, y)
+        for world_txy in used_positions:
+            minmax_tile = [(min(minmax_tile[0][0], world_txy[0]), min(minmax_tile[0][1], world_txy[1])),
+                           (max(minmax_tile[1][0], world_txy[0]), max(minmax_tile[1][1], world_txy[1]))]
+        used_tiles += len(used_positions)
+        # All 16pix tiles of this big tile has been copied into big tile
+        # Time to save big tile
+        if not big_tile is None:
+            tile = base_tile_index(tile_level, x, y)
+            tile_store.save(tile_level, tile, big_tile)
+            if keep_images:
+                images.append((tile, big_tile))
+    cache_counts = (decoded_tile_cache.hits - cache_counts[0], decoded_tile_cache.misses - cache_counts[1],
+                    identical_tiles - cache_counts[2])
+    return used_tiles, minmax_tile, images, cache_counts
+
+
+_worker_reader = None
+_worker_tile_store = None
+
+
+def _init_worker(tile_store, database_directory=None, store_history=False, timed=False):
+    global _worker_reader, _worker_tile_store
+    # Spawned workers do not inherit the enabled timer
+    phase_timer.enabled = timed
+    # Forked workers receive the object of the main process without pickling, reset it as __getstate__ does
+    tile_store.__dict__.update(tile_store.__getstate__())
+    _worker_tile_store = tile_store
+    # Forked workers start with a copy of the main process stats
+    pop_worker_stats()
+    if database_directory is not None:
+        _worker_reader = MapReader(database_directory, store_history, read_only=True)
+
+
+def _render_base_tiles_worker(args):
+    tile_level, tiles, keep_images = args
+    used_tiles, minmax_tile, images, cache_counts = render_base_tiles(_worker_reader, _worker_tile_store, tile_level,
+                                                                      tiles, keep_images)
+    _worker_tile_store.flush()
+    # Send raw pixels and the stats back to the main process
+    return (used_tiles, minmax_tile, [(tile, image.tobytes()) for tile, image in images], cache_counts,
+            pop_worker_stats())
+
+
+def create_low_zoom_tiles(tile_output_path, tile_level_native, jobs=1, changed_tiles=None, tile_store=None):
     """
         Merge 4 tiles of 256x256 into a big 512x512 tile then resize to 256x256
+        @param jobs number of worker processes, all tiles of a zoom level are done before starting the next one
+        @param changed_tiles if set, leaflet index of the only base tiles that have changed. Only their lower zoom
+        tiles are done again.
+        @param tile_store TileFolder or TilePackage where tiles are read and saved, tile_output_path by default
     """
     lastprint = 0
+    if tile_store is None:
+        tile_store = TileFolder(tile_output_path)
+    pool = None
+    if jobs > 1:
+        tile_store.disconnect()
+        pool = multiprocessing.Pool(jobs, _init_worker, (tile_store, None, False, phase_timer.enabled))
     for tile_level in range(tile_level_native, 0, -1):
-        z_path = os.path.join(tile_output_path, str(tile_level))
-        z_lower_path = os.path.join(tile_output_path, str(tile_level - 1))
-        if not os.path.exists(z_lower_path):
-            os.mkdir(z_lower_path)
-        # list all X folders, convert to int then sort ascending
-        tiles_to_process = set()
-        x_paths = map(lambda x: int(x), os.listdir(z_path))
-        for x_path in sorted(x_paths):
-            for y_path in map(lambda y: int(y[:-4]), os.listdir(os.path.join(z_path, str(x_path)))):
-                tiles_to_process.add((x_path, y_path))
-        while len(tiles_to_process) > 0:
+        lower_tiles = {}
+        if changed_tiles is None:
+            # group tiles by their lower zoom tile
+            for tile in tile_store.list_tiles(tile_level):
+                lower_tiles.setdefault((tile[0] // 2, tile[1] // 2), []).append(tile)
+        else:
+            # lower zoom tiles of changed tiles are made of the changed tiles and the existing tiles around
+            for lower_tile in set((tile[0] // 2, tile[1] // 2) for tile in changed_tiles):
+                lower_tiles[lower_tile] = [tile for tile in lower_zoom_tile_children(lower_tile)
+                                           if tile_store.exists(tile_level, tile)]
+            changed_tiles = lower_tiles.keys()
+        lower_tiles = list(lower_tiles.items())
+        # Send lower tiles by small groups, tiles are written by each worker at the end of a group
+        tasks = [(tile_level, lower_tiles[i:i + 16]) for i in range(0, len(lower_tiles), 16)]
+        if pool is not None:
+            results = pool.imap_unordered(_create_low_zoom_tiles_worker, tasks)
+        else:
+            results = ((create_low_zoom_tile_group(tile_store, tile_level, group), None) for _, group in tasks)
+        done_tiles = 0
+        for group_tiles, stats in results:
+            merge_worker_stats(stats)
+            done_tiles += group_tiles
             if time.time() - lastprint > 1:
-                print("Zoom level ", tile_level - 1, ", ", len(tiles_to_process), " tiles left")
+                print("Zoom level ", tile_level - 1, ", ", len(lower_tiles) - done_tiles, " tiles left")
                 lastprint = time.time()
-            tile_to_process = next(iter(tiles_to_process))
-            # compute id of origin tile
-            orig_tile = (tile_to_process[0] - tile_to_process[0] % 2, tile_to_process[1] - tile_to_process[1] % 2)
-            # compute the index of the 4 tiles
-            tiles = [orig_tile, #bottom left
-                     (orig_tile[0] + 1, orig_tile[1]), #bottom right
-                     (orig_tile[0], orig_tile[1] + 1), #top left
-                     (orig_tile[0] + 1, orig_tile[1] + 1)] #top right
-            tiles_paste_pos = [(0, 0), (256, 0), (0, 256), (256, 256)]
-            # Remove tiles from processing
-            missing_tiles = set()
-            for tile_index in tiles:
-                if tile_index in tiles_to_process:
-                    tiles_to_process.remove(tile_index)
-                else:
-                    missing_tiles.add(tile_index)
-            lower_zoom_image = Image.new("RGBA", (512, 512))
-            for tile_index, paste_pos in zip(*[tiles, tiles_paste_pos]):
-                if tile_index not in missing_tiles:
-                    # Compute path
-                    tile_index_path = os.path.join(z_path, str(tile_index[0]), str(tile_index[1])+".png")
-                    tile_im = Image.open(tile_index_path)
-                    # Paste in big image
-                    lower_zoom_image.paste(tile_im, paste_pos)
-            # Dezoom the big tile
-            lower_zoom_image = lower_zoom_image.resize((256, 256), Image.BICUBIC)
-            # Save in lower zoom folder
-            x_lower_path = os.path.join(z_lower_path, str(((orig_tile[0] + (2 ** tile_level) // 2) // 2)
-                                                          - (2 ** (tile_level - 1)) // 2))
-            if not os.path.exists(x_lower_path):
-                os.mkdir(x_lower_path)
-            lower_zoom_image.save(os.path.join(x_lower_path, str(((orig_tile[1] + (2 ** tile_level) // 2) // 2)
-                                                                 - (2 ** (tile_level - 1)) // 2) + ".png"))
+        tile_store.flush()
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+
+def lower_zoom_tile_children(lower_tile):
+    """
+    @return the index of the 4 tiles of the upper zoom level that compose the lower zoom tile
+    """
+    return [(lower_tile[0] * 2 + dx, lower_tile[1] * 2 + dy) for dy in range(2) for dx in range(2)]
+
+
+def compose_low_zoom_tile(images):
+    """
+    Merge up to 4 tiles of 256x256 into a big 512x512 tile then resize it to 256x256
+    @param images list of x,y tile index and image
+    """
+    with phase_timer.measure("downsample"):
+        lower_zoom_image = Image.new("RGBA", (512, 512))
+        for tile_index, tile_im in images:
+            # Paste in big image, odd x on the right and odd y on the bottom
+            lower_zoom_image.paste(tile_im, ((tile_index[0] % 2) * 256, (tile_index[1] % 2) * 256))
+        # Dezoom the big tile
+        return lower_zoom_image.resize((256, 256), Image.BICUBIC)
+
+
+def create_low_zoom_tile(tile_store, tile_level, lower_tile, tiles):
+    """
+    Read tiles and save the lower zoom tile made of them
+    @param lower_tile x, y index of the tile in the lower zoom level
+    @param tiles x, y index of the existing tiles that compose the lower tile
+    """
+    images = [(tile_index, tile_store.open(tile_level, tile_index)) for tile_index in tiles]
+    tile_store.save(tile_level - 1, lower_tile, compose_low_zoom_tile(images))
+
+
+def create_low_zoom_tile_group(tile_store, tile_level, lower_tiles):
+    """
+    @param lower_tiles list of lower zoom tile index and the index of the existing tiles that compose it
+    @return the number of saved lower zoom tiles
+    """
+    for lower_tile, tiles in lower_tiles:
+        create_low_zoom_tile(tile_store, tile_level, lower_tile, tiles)
+    return len(lower_tiles)
+
+
+def _create_low_zoom_tiles_worker(args):
+    tile_level, lower_tiles = args
+    saved_tiles = create_low_zoom_tile_group(_worker_tile_store, tile_level, lower_tiles)
+    _worker_tile_store.flush()
+    return saved_tiles, pop_worker_stats()
+
+
+class TileRenderer:
+    """
+    Render tiles of any zoom level on demand from the tile database, instead of rendering the whole pyramid with
+    create_tiles. Rendered tiles are saved in the TileFolder and read from it afterwards.
+    Thread safe, a tile requested by several threads at once is rendered once.
+    """
+    def __init__(self, tile_output_path, tile_level_native, store_history):
+        """
+        @param tile_output_path folder of the tile database, where tiles are saved
+        @param tile_level_native zoom level of the base tiles, -z of map_reader.py
+        @param store_history the database has been written with -n
+        """
+        self.tile_output_path = tile_output_path
+        self.tile_level_native = tile_level_native
+        self.store_history = store_history
+        self.tile_store = TileFolder(tile_output_path)
+        self.db_path = os.path.join(tile_output_path, 'tile_history.db')
+        # sqlite connections can not be shared between threads
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        # (zoom level, tile) -> Event set when the render is done
+        self.rendering = {}
+        # Tiles that contain known tiles, reloaded when the database change
+        self.db_version = None
+        self.known_tiles = {}
+
+    def database_version(self):
+        versions = []
+        for path in (self.db_path, self.db_path + "-wal"):
+            if os.path.exists(path):
+                file_stat = os.stat(path)
+                versions.append((file_stat.st_mtime, file_stat.st_size))
+        return versions
+
+    def reader(self):
+        reader = getattr(self.local, "reader", None)
+        if reader is None:
+            reader = self.local.reader = MapReader(self.tile_output_path, self.store_history, read_only=True)
+        return reader
+
+    def has_tile(self, tile_level, tile):
+        """
+        @return True if the tile contains at least one known tile
+        """
+        db_version = self.database_version()
+        if db_version != self.db_version:
+            self.db_version = db_version
+            positions = [record[0] for record in self.reader().db.execute("SELECT DISTINCT POS FROM TILES")]
+            self.known_tiles = pyramid_tiles(positions, self.tile_level_native)
+        return tile in self.known_tiles.get(tile_level, ())
+
+    def render(self, tile_level, tile):
+        """
+        Render the tile if it is not in the tile folder, or wait for the thread that is rendering it
+        @param tile x, y leaflet index of the tile
+        @return True if the tile is in the tile folder, False if there is nothing to show there
+        """
+        key = (tile_level, tile)
+        with self.lock:
+            done = self.rendering.get(key)
+            if done is None:
+                if self.tile_store.exists(tile_level, tile):
+                    return True
+                if not self.has_tile(tile_level, tile):
+                    return False
+                done = self.rendering[key] = threading.Event()
+                owner = True
+            else:
+                owner = False
+        if not owner:
+            done.wait()
+            return self.tile_store.exists(tile_level, tile)
+        image = None
+        try:
+            image = self.render_image(tile_level, tile)
+            if image is not None:
+                self.tile_store.save(tile_level, tile, image)
+        finally:
+            with self.lock:
+                del self.rendering[key]
+            done.set()
+        return image is not None
+
+    def render_image(self, tile_level, tile):
+        """
+        @return the image of the tile, made of the tiles of the upper zoom level that are rendered first
+        """
+        if tile_level == self.tile_level_native:
+            big_tile_range = 2**tile_level
+            x, y = tile[0] + big_tile_range // 2, big_tile_range // 2 - tile[1]
+            return render_base_tile(self.reader(), tile_level, x, y)[0]
+        images = [(child, self.tile_store.open(tile_level + 1, child))
+                  for child in lower_zoom_tile_children(tile) if self.render(tile_level + 1, child)]
+        if len(images) == 0:
+            return None
+        return compose_low_zoom_tile(images)
 
 
 def read_folder(path):
@@ -308,6 +1593,20 @@ def usage():
     print(" -t \"tiles\":\t\t The folder that will contain tiles (Optional)")
     print(" -z 8:\t\t\t\t Zoom level 4-n. Number of tiles to extract around position 0,0 of map."
           " It is in the form of 4^n tiles.It will extract a grid of 2^n*16 tiles on each side.(Optional)")
+    print(" -j 1:\t\t\t\t Number of worker processes used to read .map files, render tiles and zoom levels"
+          ".(Optional)")
+    print(" -m 256:\t\t\t Build zoom levels in memory while rendering, keeping at most this number of tiles"
+          " in memory.(Optional)")
+    print(" -f :\t\t\t\t Render all tiles, not only the ones changed since the last run.(Optional)")
+    print(" -d :\t\t\t\t Hard link identical tiles instead of writing them again.(Optional)")
+    print(" -p \"tiles.mbtiles\":\t Write all zoom levels into this SQLite tile package instead of png files"
+          ".(Optional)")
+    print(" --profile=\"profile.pstats\": Write the cProfile statistics of the main process in this file, then print"
+          " the time taken by each phase of the render.(Optional)")
+    print(" --stats=\"stats.json\":\t Write the counters of the run in this file, and in the Prometheus text format"
+          " in stats.prom.(Optional)")
+    print(" -i :\t\t\t\t Only import .map files, tiles are rendered on demand by simple_server.py --render"
+          ".(Optional)")
     print(
         "-n :\t\t\t\t Keep track of updates and write the last version of tiles. This will show players bases on "
         "map.(Optional)")
@@ -318,15 +1617,40 @@ def main():
     tile_path = "tiles"
     tile_zoom = 8
     store_history = False
+    jobs = 1
+    cache_size = 0
+    full_render = False
+    deduplicate = False
+    package_path = None
+    import_only = False
+    profile_path = None
+    stats_path = None
+    print("Welcome to 7DTD leaflet builder version " + __version__)
     # parse command line options
     try:
-        for opt, value in getopt.getopt(sys.argv[1:], "g:t:z:n")[0]:
+        for opt, value in getopt.getopt(sys.argv[1:], "g:t:z:nj:m:fdp:i", ["profile=", "stats="])[0]:
             if opt == "-g":
                 game_player_path = value
             elif opt == "-t":
                 tile_path = value
             elif opt == "-z":
                 tile_zoom = int(value)
+            elif opt == "-j":
+                jobs = max(1, int(value))
+            elif opt == "-m":
+                cache_size = int(value)
+            elif opt == "-f":
+                full_render = True
+            elif opt == "-d":
+                deduplicate = True
+            elif opt == "-p":
+                package_path = value
+            elif opt == "-i":
+                import_only = True
+            elif opt == "--profile":
+                profile_path = value
+            elif opt == "--stats":
+                stats_path = value
             elif opt == "-n":
                 store_history = True
                 print("Store all version of tiles, may take huge disk space")
@@ -354,7 +1678,25 @@ def main():
     if len(map_files) == 0:
         print("No .map files found in ", game_player_path)
         exit(-1)
-    create_tiles(map_files, tile_path, tile_zoom, store_history)
+    phase_timer.enabled = profile_path is not None or stats_path is not None
+    if profile_path is not None:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    if import_only:
+        import_tiles(map_files, tile_path, tile_zoom, store_history, jobs)
+    else:
+        create_tiles(map_files, tile_path, tile_zoom, store_history, jobs, cache_size, full_render, deduplicate,
+                     package_path)
+    if profile_path is not None:
+        profiler.disable()
+        profiler.dump_stats(profile_path)
+        pstats.Stats(profile_path).sort_stats("cumulative").print_stats(15)
+        # Times of the worker processes are summed with -j
+        print(phase_timer.table())
+    if stats_path is not None:
+        run_stats.write(stats_path)
 
 if __name__ == "__main__":
+    # Required by worker processes of the windows executable
+    multiprocessing.freeze_support()
     main()
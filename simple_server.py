@@ -1,21 +1,517 @@
+from __future__ import print_function
 import sys
-import BaseHTTPServer
-from SimpleHTTPServer import SimpleHTTPRequestHandler
+import os
+import re
+import io
+import sqlite3
+import threading
+import getopt
+import collections
+import posixpath
+import mimetypes
+import email.utils
+import gzip
+try:
+    import BaseHTTPServer
+    from SimpleHTTPServer import SimpleHTTPRequestHandler
+    import Queue as queue
+    from urllib import unquote
+except ImportError:
+    # Python 3
+    import http.server as BaseHTTPServer
+    from http.server import SimpleHTTPRequestHandler
+    import queue
+    from urllib.parse import unquote
 
+# Leaflet tile url, see index.html
+TILE_URL = re.compile(r"^/tiles/(-?\d+)/(-?\d+)/(-?\d+)\.png$")
+# Text files of the web page that have a gzip copy, see compress_assets
+COMPRESSED_EXTENSIONS = (".html", ".js", ".css")
 
-HandlerClass = SimpleHTTPRequestHandler
-ServerClass  = BaseHTTPServer.HTTPServer
-Protocol     = "HTTP/1.0"
 
-if sys.argv[1:]:
-    port = int(sys.argv[1])
-else:
-    port = 8000
-server_address = ('127.0.0.1', port)
+class TilePackageReader:
+    """
+    Read tiles from a package written by map_reader.py -p
+    """
+    def __init__(self, package_path):
+        self.package_path = package_path
+        # sqlite connections can not be shared between threads
+        self.local = threading.local()
 
-HandlerClass.protocol_version = Protocol
-httpd = ServerClass(server_address, HandlerClass)
+    def version(self):
+        """
+        @return value that change when the package is written
+        """
+        # Written pages stay in the write-ahead log until a checkpoint
+        wal_path = self.package_path + "-wal"
+        return (file_version(os.stat(self.package_path)),
+                file_version(os.stat(wal_path)) if os.path.exists(wal_path) else None)
 
-sa = httpd.socket.getsockname()
-print "Serving HTTP on", sa[0], "port", sa[1], "..."
-httpd.serve_forever()
\ No newline at end of file
+    def read(self, tile_level, x, y):
+        """
+        @return tuple of the tile id, a digest of its pixels, and the png data. None if there is no such tile
+        """
+        db = getattr(self.local, "db", None)
+        if db is None:
+            db = self.local.db = sqlite3.connect(self.package_path)
+        data = db.execute("SELECT map.tile_id, images.tile_data FROM map JOIN images ON images.tile_id = map.tile_id"
+                          " WHERE zoom_level=? AND tile_column=? AND tile_row=?", [tile_level, x, y]).fetchone()
+        if data is None:
+            return None
+        return data[0], bytes(data[1])
+
+
+class TileMemoryCache:
+    """
+    Least recently used tiles kept in memory, up to a total size in bytes. Each entry has a version, usually the
+    modification time of its file, an entry with another version is dropped.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        # key -> (version, value, size in bytes)
+        self.items = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, version):
+        with self.lock:
+            item = self.items.pop(key, None)
+            if item is None:
+                return None
+            if item[0] != version:
+                # Outdated
+                self.bytes -= item[2]
+                return None
+            self.items[key] = item
+            return item[1]
+
+    def put(self, key, version, value, size):
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            item = self.items.pop(key, None)
+            if item is not None:
+                self.bytes -= item[2]
+            self.items[key] = (version, value, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                self.bytes -= self.items.popitem(last=False)[1][2]
+
+
+def file_version(fs):
+    return fs.st_mtime, fs.st_size
+
+
+class ThreadPoolHTTPServer(BaseHTTPServer.HTTPServer):
+    """
+    HTTP server that handle connections with a fixed number of threads
+    """
+    def __init__(self, server_address, handler_class, workers):
+        BaseHTTPServer.HTTPServer.__init__(self, server_address, handler_class)
+        self.connections = queue.Queue()
+        for i in range(workers):
+            worker = threading.Thread(target=self.process_connections)
+            worker.daemon = True
+            worker.start()
+
+    def process_request(self, request, client_address):
+        self.connections.put((request, client_address))
+
+    def process_connections(self):
+        while True:
+            request, client_address = self.connections.get()
+            try:
+                # Keep alive connections stay in the handler until closed or idle
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+
+# Answer of TileSite.respond, body is bytes, an open file at the position of the first byte to send or None,
+# length is the number of bytes of the body to send
+Response = collections.namedtuple("Response", ["status", "headers", "body", "length"])
+
+
+class TileSite:
+    """
+    Files and tiles served to the browser, shared by the threaded and the asyncio servers.
+    Tiles are read from the tile package if there is one.
+    Responses carry an ETag and a Cache-Control max-age, requests with a matching If-None-Match get a 304.
+    """
+    def __init__(self, root, tile_package=None, tile_cache=None, tile_max_age=300, static_max_age=86400,
+                 tile_renderer=None):
+        self.root = root
+        self.tile_package = tile_package
+        # Optional TileMemoryCache of tiles
+        self.tile_cache = tile_cache
+        # Optional map_reader.TileRenderer of the tiles folder, missing tiles are rendered on demand
+        self.tile_renderer = tile_renderer
+        # Browser cache duration in seconds of tiles, that change on each render, and of other files
+        self.tile_max_age = tile_max_age
+        self.static_max_age = static_max_age
+
+    @staticmethod
+    def path_words(path):
+        """
+        @return folder and file names of the url path, parent folder and drive components are dropped
+        """
+        # Same filter as SimpleHTTPRequestHandler, colons of windows drives and NTFS streams are also refused
+        return [word for word in posixpath.normpath(unquote(path)).split('/')
+                if word and not os.path.dirname(word) and not os.path.splitdrive(word)[0] and ":" not in word and
+                word not in (os.curdir, os.pardir)]
+
+    @staticmethod
+    def is_in_tile_folder(path):
+        """
+        @return True if the url path is in the tiles folder, windows ignores the case and the trailing dots and spaces
+        """
+        words = TileSite.path_words(path)
+        return len(words) > 0 and words[0].rstrip(". ").lower() == "tiles"
+
+    def translate_path(self, path):
+        """
+        @return file path of the url path, see path_words
+        """
+        file_path = os.path.join(self.root, *self.path_words(path))
+        if os.path.isdir(file_path) and path.endswith("/"):
+            for index in ("index.html", "index.htm"):
+                if os.path.isfile(os.path.join(file_path, index)):
+                    return os.path.join(file_path, index)
+        return file_path
+
+    def respond(self, path, request_headers):
+        """
+        Read a tile or a file. Blocking, the asyncio server calls it from a thread.
+        @param path url path without the query
+        @param request_headers mapping of request header names in lower case to their value
+        @return Response, None if the path is not a file
+        """
+        match = TILE_URL.match(path)
+        if self.tile_package is not None and match is not None:
+            tile = None
+            if self.tile_cache is not None:
+                version = self.tile_package.version()
+                tile = self.tile_cache.get(path, version)
+            if tile is None:
+                tile = self.tile_package.read(*[int(value) for value in match.groups()])
+                if tile is None:
+                    return Response(404, [], None, 0)
+                if self.tile_cache is not None:
+                    self.tile_cache.put(path, version, tile, len(tile[1]))
+            tile_id, data = tile
+            return self.cached_response('"%s"' % tile_id, self.tile_max_age, request_headers,
+                                        [("Content-type", "image/png")], data, len(data))
+        if self.tile_renderer is not None and match is not None:
+            tile_level, x, y = [int(value) for value in match.groups()]
+            if not self.tile_renderer.render(tile_level, (x, y)):
+                return Response(404, [], None, 0)
+        if match is None and self.is_in_tile_folder(path):
+            # Only tiles are served from the tile folder, tile_history.db holds the player bases hidden by the map
+            return Response(404, [], None, 0)
+        file_path = self.translate_path(path)
+        if not os.path.isfile(file_path):
+            return None
+        content_path, headers, etag_suffix = file_path, [], ""
+        if file_path.endswith(COMPRESSED_EXTENSIONS):
+            headers.append(("Vary", "Accept-Encoding"))
+            if accepts_gzip(request_headers.get("accept-encoding")) and is_compressed(file_path):
+                content_path, etag_suffix = file_path + ".gz", "-gzip"
+                headers.append(("Content-Encoding", "gzip"))
+        try:
+            if match is not None and self.tile_cache is not None:
+                # Tile read from memory
+                fs = os.stat(file_path)
+                body = self.tile_cache.get(file_path, file_version(fs))
+                if body is None:
+                    with open(file_path, 'rb') as tile_file:
+                        body = tile_file.read()
+                    self.tile_cache.put(file_path, file_version(fs), body, len(body))
+            else:
+                body = open(content_path, 'rb')
+                fs = os.fstat(body.fileno())
+        except (IOError, OSError):
+            return Response(404, [], None, 0)
+        # Strong validator from the modification time and the size, each encoding is another version
+        etag = '"%x-%x%s"' % (int(fs.st_mtime * 1000000), fs.st_size, etag_suffix)
+        max_age = self.tile_max_age if path.startswith("/tiles/") else self.static_max_age
+        response = self.cached_response(etag, max_age, request_headers, headers + [
+            ("Content-type", mimetypes.guess_type(file_path)[0] or "application/octet-stream"),
+            ("Last-Modified", email.utils.formatdate(fs.st_mtime, usegmt=True))], body, fs.st_size)
+        if response.body is None and not isinstance(body, bytes):
+            body.close()
+        return response
+
+    @staticmethod
+    def cached_response(etag, max_age, request_headers, headers, body, size):
+        """
+        @param body bytes or open file of the whole content
+        @return the response with its cache headers, 304 Not Modified if the client already has this version, or
+        206 Partial Content with the requested byte range
+        """
+        if_none_match = request_headers.get("if-none-match")
+        not_modified = if_none_match is not None and (
+            if_none_match.strip() == "*" or
+            etag in [value.strip().replace("W/", "", 1) for value in if_none_match.split(",")])
+        cache_headers = [("ETag", etag), ("Cache-Control", "max-age=%d" % max_age)]
+        cache_headers += [header for header in headers if header[0] == "Vary"]
+        if not_modified:
+            return Response(304, cache_headers, None, 0)
+        headers = cache_headers + [header for header in headers if header[0] != "Vary"] + [("Accept-Ranges", "bytes")]
+        range_header = request_headers.get("range")
+        # A range of another version of the content is ignored
+        if range_header is not None and request_headers.get("if-range", etag) == etag:
+            try:
+                first, last = byte_range(range_header, size)
+            except ValueError:
+                return Response(416, [("Content-Range", "bytes */%d" % size)], None, 0)
+            if isinstance(body, bytes):
+                body = body[first:last + 1]
+            else:
+                body.seek(first)
+            return Response(206, headers + [("Content-Range", "bytes %d-%d/%d" % (first, last, size)),
+                                            ("Content-Length", str(last + 1 - first))], body, last + 1 - first)
+        return Response(200, headers + [("Content-Length", str(size))], body, size)
+
+
+def accepts_gzip(accept_encoding):
+    """
+    @param accept_encoding value of the Accept-Encoding request header or None
+    @return True if gzip has a non zero quality, a gzip entry takes precedence over *
+    """
+    qualities = {}
+    for coding in (accept_encoding or "").split(","):
+        name, _, parameters = coding.partition(";")
+        quality = 1.0
+        for parameter in parameters.split(";"):
+            key, _, value = parameter.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    # Malformed quality, the coding is not used
+                    quality = 0.0
+        qualities[name.strip().lower()] = quality
+    return qualities.get("gzip", qualities.get("*", 0.0)) > 0
+
+
+def is_compressed(file_path):
+    """
+    @return True if the gzip copy of the file is up to date
+    """
+    gz_path = file_path + ".gz"
+    return os.path.isfile(gz_path) and os.stat(gz_path).st_mtime >= os.stat(file_path).st_mtime
+
+
+def compress_assets(root):
+    """
+    Write a gzip copy next to the text files of the web page, sent to browsers that accept it instead of
+    compressing each response
+    @return number of written files
+    """
+    paths = [os.path.join(root, name) for name in ("index.html", "leaflet-src.js")]
+    for folder in ("js", "css"):
+        folder_path = os.path.join(root, folder)
+        if os.path.isdir(folder_path):
+            paths += [os.path.join(folder_path, name) for name in sorted(os.listdir(folder_path))]
+    written = 0
+    for file_path in paths:
+        if not file_path.endswith(COMPRESSED_EXTENSIONS) or not os.path.isfile(file_path) or \
+                is_compressed(file_path):
+            continue
+        with open(file_path, 'rb') as source:
+            data = source.read()
+        gz_file = gzip.GzipFile(file_path + ".gz", 'wb', 9)
+        try:
+            gz_file.write(data)
+        finally:
+            gz_file.close()
+        written += 1
+    return written
+
+
+def byte_range(range_header, size):
+    """
+    Parse a Range request header, only single ranges are supported
+    @return first and last byte offsets
+    @raise ValueError if the range can not be served
+    """
+    unit, _, byte_ranges = range_header.partition("=")
+    if unit.strip() != "bytes" or "," in byte_ranges:
+        raise ValueError("Unsupported range " + range_header)
+    first, _, last = byte_ranges.strip().partition("-")
+    if first == "":
+        # Suffix length
+        first, last = max(0, size - int(last)), size - 1
+    else:
+        first, last = int(first), min(size - 1, int(last)) if last != "" else size - 1
+    if first > last or first < 0:
+        raise ValueError("Unsatisfiable range " + range_header)
+    return first, last
+
+
+class TileRequestHandler(SimpleHTTPRequestHandler):
+    """
+    Serve the TileSite, other paths of the current folder are listed by SimpleHTTPRequestHandler
+    """
+    site = None
+    # Close idle keep alive connections after this number of seconds, to free the worker thread
+    timeout = 5
+
+    def send_head(self):
+        path = self.path.split('?', 1)[0].split('#', 1)[0]
+        response = self.site.respond(path, self.headers)
+        if response is None:
+            # Directory listing, redirection or not found
+            self.response_length = None
+            return SimpleHTTPRequestHandler.send_head(self)
+        if response.status == 404:
+            self.send_error(404, "File not found")
+            return None
+        self.send_response(response.status)
+        for name, value in response.headers:
+            self.send_header(name, value)
+        if response.status == 416:
+            self.send_header("Content-Length", "0")
+        self.end_headers()
+        self.response_length = response.length
+        if isinstance(response.body, bytes):
+            return io.BytesIO(response.body)
+        return response.body
+
+    def copyfile(self, source, outputfile):
+        """
+        Send response.length bytes of the body from its current position. Files are sent by the kernel when the
+        platform has sendfile.
+        """
+        if self.response_length is None:
+            SimpleHTTPRequestHandler.copyfile(self, source, outputfile)
+        elif not isinstance(source, io.BytesIO) and hasattr(self.connection, "sendfile"):
+            # socket.sendfile use os.sendfile, or send the file content itself if it can not
+            self.connection.sendfile(source, source.tell(), self.response_length)
+        else:
+            remaining = self.response_length
+            while remaining > 0:
+                data = source.read(min(remaining, 64 * 1024))
+                if not data:
+                    break
+                outputfile.write(data)
+                remaining -= len(data)
+
+
+def prewarm_tile_cache(site, max_zoom):
+    """
+    Load tiles of zoom levels 0 to max_zoom in the cache of the site, these tiles are requested by every visitor
+    """
+    tile_cache, tile_package = site.tile_cache, site.tile_package
+    loaded = 0
+    if tile_package is not None:
+        version = tile_package.version()
+        db = sqlite3.connect(tile_package.package_path)
+        for tile_level, x, y, tile_id, data in db.execute(
+                "SELECT zoom_level, tile_column, tile_row, map.tile_id, tile_data FROM map JOIN images ON"
+                " images.tile_id = map.tile_id WHERE zoom_level <= ? ORDER BY zoom_level", [max_zoom]):
+            tile_cache.put("/tiles/%d/%d/%d.png" % (tile_level, x, y), version, (tile_id, bytes(data)), len(data))
+            loaded += 1
+        db.close()
+    else:
+        for tile_level in range(max_zoom + 1):
+            z_path = os.path.join(site.root, "tiles", str(tile_level))
+            if not os.path.isdir(z_path):
+                continue
+            for x_path in os.listdir(z_path):
+                for y_file in os.listdir(os.path.join(z_path, x_path)):
+                    file_path = os.path.join(z_path, x_path, y_file)
+                    with open(file_path, 'rb') as tile_file:
+                        data = tile_file.read()
+                    tile_cache.put(file_path, file_version(os.stat(file_path)), data, len(data))
+                    loaded += 1
+    return loaded
+
+
+def usage():
+    print("Usage: simple_server.py [options] [port] [tile package]")
+    print(" port:\t\t\t Listening port, 8000 by default")
+    print(" tile package:\t\t Serve tiles from the package written by map_reader.py -p (Optional)")
+    print(" -b 127.0.0.1:\t\t Listening address, 0.0.0.0 to accept connections from other computers (Optional)")
+    print(" -w 16:\t\t\t Number of threads handling connections, or reading files with --async (Optional)")
+    print(" --render=8:\t\t Render missing tiles on demand from tiles/tile_history.db, 8 is the -z zoom level of"
+          " map_reader.py (Optional)")
+    print(" --history:\t\t With --render, the tile database has been written with map_reader.py -n (Optional)")
+    print(" --gzip:\t\t Write gzip copies of index.html, js and css files, sent to browsers that accept them"
+          " (Optional)")
+    print(" --async:\t\t Handle connections with asyncio, python 3 only (Optional)")
+    print(" --cache-size=64:\t Megabytes of tiles kept in memory, 0 to read tiles on each request (Optional)")
+    print(" --prewarm=4:\t\t Load tiles of zoom levels 0 to this value in memory at startup (Optional)")
+    print(" --tile-max-age=300:\t Seconds a browser keeps tiles before asking if they changed (Optional)")
+    print(" --static-max-age=86400: Seconds a browser keeps other files before asking if they changed (Optional)")
+
+
+def main():
+    address = '127.0.0.1'
+    workers = 16
+    cache_size = 64
+    prewarm = -1
+    use_asyncio = False
+    render_zoom = None
+    store_history = False
+    compress = False
+    site = TileSite(os.getcwd())
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "b:w:", ["tile-max-age=", "static-max-age=", "cache-size=",
+                                                              "prewarm=", "async", "render=", "history", "gzip"])
+        for opt, value in opts:
+            if opt == "-b":
+                address = value
+            elif opt == "-w":
+                workers = max(1, int(value))
+            elif opt == "--tile-max-age":
+                site.tile_max_age = int(value)
+            elif opt == "--static-max-age":
+                site.static_max_age = int(value)
+            elif opt == "--cache-size":
+                cache_size = int(value)
+            elif opt == "--prewarm":
+                prewarm = int(value)
+            elif opt == "--async":
+                use_asyncio = True
+            elif opt == "--render":
+                render_zoom = int(value)
+            elif opt == "--history":
+                store_history = True
+            elif opt == "--gzip":
+                compress = True
+        port = int(args[0]) if args[0:] else 8000
+    except (getopt.error, ValueError):
+        usage()
+        exit(-1)
+    if args[1:]:
+        site.tile_package = TilePackageReader(args[1])
+    if compress:
+        print("Compressed files written", compress_assets(site.root))
+    if render_zoom is not None:
+        # Pillow is only required to render tiles
+        import map_reader
+        site.tile_renderer = map_reader.TileRenderer(os.path.join(site.root, "tiles"), render_zoom, store_history)
+    if cache_size > 0:
+        site.tile_cache = TileMemoryCache(cache_size * 1024 * 1024)
+        if prewarm >= 0:
+            print("Tiles loaded in memory", prewarm_tile_cache(site, prewarm))
+    if use_asyncio:
+        # Python 3 syntax, not imported by the threaded server
+        import async_server
+        async_server.serve(site, address, port, workers)
+        return
+    TileRequestHandler.site = site
+    # Persistent connections, a browser load all tiles of the view through a few connections
+    TileRequestHandler.protocol_version = "HTTP/1.1"
+    httpd = ThreadPoolHTTPServer((address, port), TileRequestHandler, workers)
+
+    sa = httpd.socket.getsockname()
+    print("Serving HTTP on", sa[0], "port", sa[1], "with", workers, "threads ...")
+    httpd.serve_forever()
+
+
+if __name__ == "__main__":
+    main()